@@ -0,0 +1,188 @@
+"""Helpers for doing work off the Tk thread. Tk may only be used from the thread running the mainloop, so results are
+handed back through a queue which the Tk thread polls."""
+
+import collections
+import queue
+import threading
+import time
+import traceback
+
+class Dispatcher:
+
+    """Calls functions posted from any thread on the Tk thread."""
+
+    def __init__(self, root, interval=15):
+        self.root = root
+        self.interval = interval # Milliseconds between polls
+        self.calls = queue.Queue()
+        self.root.after(self.interval, self.poll)
+
+    def post(self, callback, *args):
+        self.calls.put((callback, args))
+
+    def poll(self):
+        try:
+            while True:
+                callback, args = self.calls.get_nowait()
+                callback(*args)
+        except queue.Empty:
+            pass
+
+        self.root.after(self.interval, self.poll)
+
+class LatestOnlyWorker:
+
+    """Runs jobs one at a time on a background thread. Submitting a job replaces any job that hasn't started yet, and
+    results older than the last one handed to on_done are dropped, so a burst of submissions only renders the newest."""
+
+    def __init__(self, dispatcher, name='worker'):
+        self.dispatcher = dispatcher
+        self.condition = threading.Condition()
+        self.pending = None
+        self.submitted = 0 # Generation of the newest submitted job
+        self.delivered = 0 # Generation of the newest result passed to on_done (only touched on the Tk thread)
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, on_done):
+        with self.condition:
+            self.submitted += 1
+            self.pending = (self.submitted, job, on_done)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                generation, job, on_done = self.pending
+                self.pending = None
+
+            try:
+                result = job()
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            self.dispatcher.post(self.deliver, generation, result, on_done)
+
+    def deliver(self, generation, result, on_done):
+        if generation > self.delivered:
+            self.delivered = generation
+            on_done(result)
+
+class StreamTask:
+
+    """Runs a generator on a background thread and passes what it yields to on_items on the Tk thread, in chunks
+    of everything yielded within interval seconds. generate is called with a threading.Event which is set by cancel;
+    nothing is passed to on_items (or on_done) once the task is cancelled."""
+
+    def __init__(self, dispatcher, generate, on_items, on_done=None, interval=0.1, name='stream'):
+        self.dispatcher = dispatcher
+        self.generate = generate
+        self.on_items = on_items
+        self.on_done = on_done
+        self.interval = interval
+        self.cancelled = threading.Event()
+        self.done = False
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        chunk = []
+        last_post = time.monotonic()
+
+        try:
+            for item in self.generate(self.cancelled):
+                chunk.append(item)
+
+                if time.monotonic() - last_post >= self.interval:
+                    self.dispatcher.post(self.deliver, chunk)
+                    chunk = []
+                    last_post = time.monotonic()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if chunk:
+                self.dispatcher.post(self.deliver, chunk)
+            self.dispatcher.post(self.finish)
+
+    def deliver(self, chunk):
+        if not self.cancelled.is_set():
+            self.on_items(chunk)
+
+    def finish(self):
+        self.done = True
+        if not self.cancelled.is_set() and self.on_done:
+            self.on_done()
+
+class Task:
+
+    """Calls function on a background thread with a threading.Event which is set by cancel, and passes what it returns
+    and the exception it raised (or None) to on_done on the Tk thread. Unlike StreamTask, on_done is also called once
+    a cancelled function returns, with whatever it got done."""
+
+    def __init__(self, dispatcher, function, on_done, name='task'):
+        self.dispatcher = dispatcher
+        self.function = function
+        self.on_done = on_done
+        self.cancelled = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        result, error = None, None
+        try:
+            result = self.function(self.cancelled)
+        except Exception as e:
+            traceback.print_exc()
+            error = e
+        self.dispatcher.post(self.on_done, result, error)
+
+class WorkQueue:
+
+    """Calls function with items one at a time on a background thread and passes each item and its result to on_result
+    on the Tk thread. replace swaps the items that haven't been started for new ones, so the queue always works on what
+    was asked for last (e.g. the rows that are visible now)."""
+
+    def __init__(self, dispatcher, function, on_result, name='queue'):
+        self.dispatcher = dispatcher
+        self.function = function
+        self.on_result = on_result
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def replace(self, items):
+        with self.condition:
+            self.pending = collections.deque(items)
+            self.condition.notify()
+
+    def clear(self):
+        self.replace([])
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                item = self.pending.popleft()
+
+            try:
+                result = self.function(item)
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            self.dispatcher.post(self.on_result, item, result)
@@ -0,0 +1,337 @@
+"""The batch of images being edited and the modifiers applied to them. Doesn't depend on tkinter so it can be used
+headless (see cli.py)."""
+
+from PIL import Image
+from collections import namedtuple
+from os import path
+from cache import LRUCache
+from scanner import SUPPORTED_FILE_EXTENSIONS
+from manifest import Manifest, recipe_digest
+from profiling import Profiler, image_bytes, timed
+import modifiers
+import dedupe
+import pipeline
+import planner
+import scanner
+import tiling
+
+# source is the decoded preview source, which may be smaller than size (the size the modifiers are planned for) if it
+# was decoded at a reduced size. scale is the size of a proxy source relative to the original. prefix_image is the
+# output of the confirmed modifiers (prefix) and prefix_size the size it is planned as. image is the rendered preview,
+# the output of prefix_image and the unconfirmed modifiers (suffix).
+PreviewEntry = namedtuple('PreviewEntry', ('source', 'size', 'scale', 'prefix', 'prefix_image', 'prefix_size', 'suffix', 'image'), defaults=(None, None))
+
+def preview_entry_bytes(entry):
+    # The images are often the same object, e.g. when there are no confirmed modifiers
+    images = {id(image): image for image in (entry.source, entry.prefix_image, entry.image) if image is not None}
+    return sum(image_bytes(image) for image in images.values())
+
+class ImageBatch:
+    def __init__(self):
+        self.filenames = []
+        self.modifiers = [] # What modifiers to apply in the order they should be applied
+        self.confirmed_mod_count = 0 # Records the number of confirmed modifiers
+        self.save_dest = "" # If None we overwrite the original images (TBD)
+        self.im_width = 1.0
+        self.im_height = 1.0
+        self.maintain_aspect_ratio = True
+        self.primary_dimension = 'width'
+        self.anchor = 'Top'
+        self.color = 1.0
+        self.contrast = 1.0
+        self.brightness = 1.0
+        self.sharpness = 1.0
+        self.workers = 1 # Number of processes process_all uses, 1 streams the files through a pipeline of threads
+
+        self.draft_decode = True # Decode JPEGs at a reduced size when the modifiers start with a downscale
+        self.incremental = True # Skip files the save destination's manifest says are already up to date
+        self.tile_size = tiling.TILE_SIZE # Very large images are processed in tiles of this size where possible, None never tiles
+        self.deduplicate = True # Process files with the same content once and link (or copy) the output to the others
+        self.link_duplicates = True # Hard link outputs of duplicates where the file system allows it rather than copying them
+        self.encoder_options = {} # Format name -> keyword arguments for its encoder, see pipeline.save_image
+        self.io_workers = pipeline.IO_WORKERS # Threads encoding and writing outputs when streaming
+        self.memory_budget = pipeline.MEMORY_BUDGET # Bytes of images a single worker may hold at once, see pipeline.stream_files
+        self.decode_cache = None # A decodecache.DecodeCache keeping the decoded pixels of slow formats for previews and runs
+
+        # When profile is set, process_all and previews record how long each stage takes in profiler, and
+        # process_all writes the stages of the run to trace_file if it's set
+        self.profile = False
+        self.profiler = Profiler()
+        self.trace_file = None
+
+        # Maps (preview filename, proxy size) to a PreviewEntry so that changing the unconfirmed modifier only costs
+        # one modifier application and going back to a (or a prefetched) file costs nothing
+        self.preview_cache = LRUCache(max_entries=64, max_bytes=512 << 20, sizeof=preview_entry_bytes)
+
+    def set_files(self, filenames):
+        self.filenames = list(filenames)
+        if self.filenames:
+            self.preview_image = self.filenames[0]
+
+    def scan_folder(self, dir_, cancelled=None):
+        return scanner.scan_folder(dir_, SUPPORTED_FILE_EXTENSIONS, cancelled=cancelled)
+
+    def add_files(self, filenames):
+        # Extended in place since the file pane shows this list
+        self.filenames.extend(filenames)
+
+    def set_save_dest(self, dir_):
+        self.save_dest = dir_
+
+    def set_modifiers(self, modifiers):
+        """Replaces the modifiers with a confirmed chain, e.g. one loaded from a recipe."""
+        self.modifiers = list(modifiers)
+        self.confirmed_mod_count = len(self.modifiers)
+
+    def get_processed_image(self, filename):
+        image, size = pipeline.open_image(filename, self.modifiers, draft=self.draft_decode)
+        image = pipeline.load_image(image, self.decode_cache)
+        return pipeline.apply_modifiers(image, self.modifiers, size, tile_size=self.tile_size)
+
+    def get_output_size(self, filename):
+        with Image.open(filename) as im:
+            return pipeline.get_output_size(self.modifiers, im.size)
+
+    def get_plan(self, filename):
+        with Image.open(filename) as im:
+            return planner.plan(self.modifiers, im.size)
+
+    def get_preview_entry(self, filename, modifiers, max_size=None):
+        """Returns the cached preview entry for filename, decoding the source again if it isn't cached or was decoded
+        at a size too small for modifiers. If max_size is given the source is a copy downscaled to fit within
+        max_size, so the cost of a preview doesn't depend on the size of the source."""
+
+        key = (filename, max_size)
+        entry = self.preview_cache.get(key)
+
+        if entry is not None and not max_size:
+            decode_size = pipeline.get_decode_size(modifiers, entry.size) if self.draft_decode else None
+            width, height = decode_size or entry.size
+            if entry.source.width < width or entry.source.height < height:
+                entry = None
+
+        if entry is None:
+            if max_size:
+                im = Image.open(filename)
+                full_width = im.width
+                if self.decode_cache is not None and self.decode_cache.can_cache(im):
+                    # Slow formats can't decode at a reduced size, so the thumbnail is made from the cached pixels
+                    im = self.decode_cache.load(im)
+                with im:
+                    im.thumbnail(max_size)
+                size, scale = im.size, im.width / full_width
+            else:
+                im, size = pipeline.open_image(filename, modifiers, draft=self.draft_decode)
+                im = pipeline.load_image(im, self.decode_cache)
+                scale = 1
+            entry = PreviewEntry(im, size, scale, [], im, size)
+
+        return entry
+
+    def get_prefix_image(self, filename, modifiers, confirmed_mod_count, max_size=None):
+        """Returns the output of the confirmed modifiers and the entry it came from."""
+
+        key = (filename, max_size)
+        entry = self.get_preview_entry(filename, modifiers, max_size)
+        prefix = modifiers[:confirmed_mod_count]
+
+        if entry.prefix != prefix:
+            # Modifiers only ever get confirmed one after another so usually the cached output can be extended
+            if prefix[:len(entry.prefix)] == entry.prefix:
+                new_modifiers = prefix[len(entry.prefix):]
+                prefix_im = self.apply_scaled(entry.prefix_image, new_modifiers, entry.scale, entry.prefix_size)
+            else:
+                prefix_im = self.apply_scaled(entry.source, prefix, entry.scale, entry.size)
+
+            prefix_size = pipeline.get_output_size(self.scale_modifiers(prefix, entry.scale), entry.size)
+            entry = entry._replace(prefix=prefix, prefix_image=prefix_im, prefix_size=prefix_size)
+
+        self.preview_cache.put(key, entry)
+        return entry
+
+    def get_preview_image(self, filename, max_size=None):
+        return self.get_preview_job(filename, max_size)()
+
+    def get_preview_job(self, filename, max_size=None):
+        """Returns a function that renders the preview with the modifiers as they are now. The function doesn't read
+        any state that the Tk thread changes, so it can be called from a background thread."""
+
+        modifiers = list(self.modifiers)
+        confirmed_mod_count = self.confirmed_mod_count
+        stages = [] if self.profile else None
+
+        def render():
+            entry = self.get_prefix_image(filename, modifiers, confirmed_mod_count, max_size)
+            suffix = modifiers[confirmed_mod_count:]
+            if entry.image is not None and entry.suffix == suffix:
+                return entry.image
+
+            image = self.apply_scaled(entry.prefix_image, suffix, entry.scale, entry.prefix_size)
+            self.preview_cache.put((filename, max_size), entry._replace(suffix=suffix, image=image))
+            return image
+
+        def profiled_render():
+            image = timed(stages, filename, 'preview', render)
+            self.profiler.add(stages)
+            return image
+
+        return profiled_render if self.profile else render
+
+    def discard_rendered_previews(self):
+        """Drops the cached previews rendered with modifiers that have since changed, keeping the decoded sources and
+        outputs of the confirmed modifiers."""
+
+        # Putting every entry back in least recently used order keeps the order
+        for key, entry in self.preview_cache.items():
+            if entry.image is not None and entry.suffix != self.modifiers[self.confirmed_mod_count:]:
+                entry = entry._replace(suffix=None, image=None)
+            self.preview_cache.put(key, entry)
+
+    def scale_modifiers(self, modifiers, scale):
+        if scale == 1:
+            return modifiers
+        return [modifier.scaled(scale) for modifier in modifiers]
+
+    def apply_scaled(self, image, modifiers, scale, size):
+        return pipeline.apply_modifiers(image, self.scale_modifiers(modifiers, scale), size)
+
+    def get_recipe_digest(self):
+        options = dict(draft=self.draft_decode, plan=planner.PLAN_VERSION)
+        if self.encoder_options:
+            options['encoder'] = self.encoder_options
+        return recipe_digest(self.modifiers, **options)
+
+    def process_all(self, workers=None, coordinator=None, filenames=None, outfiles=None, on_result=None, progress=None, cancelled=None,
+                    manifest=None):
+        """Processes the files (or filenames rather than the batch's files) and returns a pipeline.FileResult for each
+        file that was processed. outfiles are the output paths of the files, by default pipeline.get_outfiles of the
+        files into the save destination. on_result is called with each FileResult as soon as it's available, and progress (a
+        profiling.Progress) is started with the number of files to process and counts them. Setting cancelled (a
+        threading.Event) stops the run between files, see pipeline.process_files. When incremental,
+        files that are up to date in the save destination are skipped. When deduplicating, only the first of the files
+        with the same content is processed and its output is linked (or copied) to the outputs of the others, which
+        have a FileResult without stages.
+
+        If coordinator (a spool.Coordinator) is given the files are processed by the workers serving its spool. manifest
+        (a manifest.Manifest of the save destination) is used rather than loading it, and compacting it is then left to
+        the caller, which saves reading and rewriting the whole manifest for every call of a long running caller."""
+
+        if workers is None:
+            workers = self.workers
+        if filenames is None:
+            filenames = self.filenames
+
+        # The Tk thread may change the modifiers while a run is under way
+        modifiers = list(self.modifiers)
+
+        # Outputs are worked out from every file so they don't move around depending on which files are up to date.
+        # The manifest is kept even when not incremental since it knows which input every existing output belongs to.
+        own_manifest = manifest is None
+        if own_manifest:
+            manifest = Manifest(self.save_dest, self.get_recipe_digest())
+        if outfiles:
+            outfiles = manifest.claim_outfiles(filenames, outfiles)
+        else:
+            outfiles = pipeline.get_outfiles(filenames, self.save_dest, manifest.owners)
+        outfiles = dict(zip(filenames, outfiles))
+
+        if self.incremental:
+            filenames = [filename for filename in filenames if not manifest.is_current(filename, outfiles[filename])]
+        duplicates = {}
+
+        if self.deduplicate:
+            groups = dedupe.group_identical(filenames)
+            filenames = [group[0] for group in groups]
+            duplicates = {group[0]: group[1:] for group in groups if len(group) > 1}
+
+        run_profiler = Profiler()
+        results = []
+        if progress is not None:
+            progress.start(len(filenames) + sum(map(len, duplicates.values())))
+
+        def record(result):
+            results.append(result)
+            manifest.record(result.filename, result.digest, result.outfile)
+            if result.stages:
+                run_profiler.add(result.stages)
+                self.profiler.add(result.stages)
+            if progress is not None:
+                try:
+                    progress.add(path.getsize(result.filename))
+                except OSError:
+                    progress.add(0)
+            if on_result:
+                on_result(result)
+
+        def record_with_duplicates(result):
+            record(result)
+            for duplicate in duplicates.get(result.filename, []):
+                dedupe.materialize(result.outfile, outfiles[duplicate], link=self.link_duplicates)
+                record(pipeline.FileResult(duplicate, outfiles[duplicate], result.digest))
+
+        options = dict(draft=self.draft_decode, digest=self.incremental, tile_size=self.tile_size, encoder_options=self.encoder_options,
+                       memory_budget=self.memory_budget, io_workers=self.io_workers)
+        run_outfiles = [outfiles[filename] for filename in filenames]
+
+        try:
+            if coordinator is not None:
+                coordinator.run(filenames, run_outfiles, modifiers, options, on_result=record_with_duplicates)
+            else:
+                pipeline.process_files(filenames, modifiers, self.save_dest, workers=workers, profile=self.profile, decode_cache=self.decode_cache,
+                                       outfiles=run_outfiles, on_result=record_with_duplicates, cancelled=cancelled, **options)
+            return results
+        finally:
+            if own_manifest:
+                manifest.compact()
+            if self.profile and self.trace_file:
+                run_profiler.write_trace(self.trace_file)
+
+    def set_workers(self, workers):
+        self.workers = max(1, int(workers))
+
+    def confirm_modifier(self):
+        self.confirmed_mod_count += 1
+
+    def cancel_modifier(self):
+        try:
+            del self.modifiers[self.confirmed_mod_count]
+        except IndexError:
+            pass
+
+    def add_modifier(self, modifier):
+        try:
+            self.modifiers[self.confirmed_mod_count] = modifier
+        except IndexError:
+            self.modifiers.append(modifier)
+
+    def set_image_size(self, width, height, maintain_aspect_ratio, primary_dimension='width'):
+        self.im_width = width
+        self.im_height = height
+        self.maintain_aspect_ratio = maintain_aspect_ratio
+        self.primary_dimension = primary_dimension
+        self.add_modifier(modifiers.ResizeModifier(self.im_width, self.im_height, self.maintain_aspect_ratio, primary_dimension=self.primary_dimension))
+
+    def set_image_crop(self, width, height, maintain_aspect_ratio, primary_dimension='width', anchor='Top'):
+        self.im_width = width
+        self.im_height = height
+        self.maintain_aspect_ratio = maintain_aspect_ratio
+        self.primary_dimension = primary_dimension
+        self.anchor = anchor
+        modifier = modifiers.CropModifier(self.im_width, self.im_height, self.maintain_aspect_ratio, primary_dimension=self.primary_dimension, anchor=self.anchor)
+        self.add_modifier(modifier)
+
+    def set_color(self, value):
+        self.color = float(value)
+        self.add_modifier(modifiers.ColorModifier(self.color))
+
+    def set_contrast(self, value):
+        self.contrast = float(value)
+        self.add_modifier(modifiers.ContrastModifier(self.contrast))
+
+    def set_brightness(self, value):
+        self.brightness = float(value)
+        self.add_modifier(modifiers.BrightnessModifier(self.brightness))
+
+    def set_sharpness(self, value):
+        self.sharpness = float(value)
+        self.add_modifier(modifiers.SharpnessModifier(self.sharpness))
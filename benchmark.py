@@ -0,0 +1,295 @@
+"""Benchmarks the modifiers and end-to-end batch throughput on synthetic images.
+
+    python benchmark.py -o before.json
+    ... change something ...
+    python benchmark.py -o after.json
+    python benchmark.py --compare before.json after.json
+
+Three kinds of case are timed:
+    modifier  each ImageModifier subclass's apply on its own, for every image mode and size
+    chain     representative modifier chains through ImageBatch.get_processed_image (decode included), in the modes
+              they work in (only crops and resizes work in P and I;16)
+    batch     the same chains through ImageBatch.process_all (decode, process and save), serially and with workers
+
+Chain and batch cases run in a fresh process each so their peak RSS can be measured. Throughput is reported as
+images/s and MB/s of decoded input pixels."""
+
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import PIL
+import modifiers
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+SIZES = {
+    'small': (640, 480),
+    'medium': (1920, 1080),
+    'large': (4000, 3000),
+}
+
+MODES = ('RGB', 'RGBA', 'L', 'P', 'I;16')
+
+# Format each mode is saved as for the chain and batch cases
+FORMATS = {'RGB': 'JPEG', 'RGBA': 'PNG', 'L': 'JPEG', 'P': 'PNG', 'I;16': 'TIFF'}
+
+MODIFIERS = {
+    'color': lambda: modifiers.ColorModifier(1.3),
+    'contrast': lambda: modifiers.ContrastModifier(1.2),
+    'brightness': lambda: modifiers.BrightnessModifier(1.1),
+    'sharpness': lambda: modifiers.SharpnessModifier(2.0),
+    'resize': lambda: modifiers.ResizeModifier(0.5, 0.5, True),
+    'crop': lambda: modifiers.CropModifier(0.5, 0.5, False, anchor='Middle'),
+    'point': lambda: modifiers.PointModifier([modifiers.ContrastModifier(1.2), modifiers.ColorModifier(1.3), modifiers.BrightnessModifier(1.1)]),
+}
+
+CHAINS = {
+    'adjust': lambda: [modifiers.ColorModifier(1.3), modifiers.ContrastModifier(1.2), modifiers.BrightnessModifier(1.1)],
+    'downscale': lambda: [modifiers.BrightnessModifier(1.1), modifiers.ResizeModifier(0.25, 0.25, True)],
+    'full': lambda: [
+        modifiers.CropModifier(0.9, 0.9, False, anchor='Top Left'),
+        modifiers.ResizeModifier(0.5, 0.5, True),
+        modifiers.ColorModifier(1.3),
+        modifiers.ContrastModifier(1.2),
+        modifiers.BrightnessModifier(1.1),
+        modifiers.SharpnessModifier(2.0),
+    ],
+    'geometry': lambda: [modifiers.CropModifier(0.9, 0.9, False, anchor='Middle'), modifiers.ResizeModifier(0.5, 0.5, True)],
+}
+
+# Modes ImageEnhance works in, chains with other modifiers than crops and resizes are only run in these
+ENHANCE_MODES = ('RGB', 'RGBA', 'L')
+
+def make_image(mode, size):
+    """Returns a deterministic image with some structure (a fractal plus gradients) so encoders have real work."""
+
+    width, height = size
+    fractal = Image.effect_mandelbrot(size, (-2.0, -1.25, 0.75, 1.25), 64)
+    horizontal = Image.linear_gradient('L').transpose(Image.ROTATE_90).resize(size)
+    vertical = Image.linear_gradient('L').resize(size)
+    rgb = Image.merge('RGB', (fractal, horizontal, vertical))
+
+    if mode == 'RGB':
+        return rgb
+    if mode == 'RGBA':
+        rgba = rgb.copy()
+        rgba.putalpha(vertical)
+        return rgba
+    if mode == 'L':
+        return rgb.convert('L')
+    if mode == 'P':
+        return rgb.quantize(256)
+    if mode == 'I;16':
+        return rgb.convert('L').convert('I').point(lambda value: value * 257).convert('I;16')
+
+    raise ValueError(f'unsupported mode {mode}')
+
+def pixel_bytes(image):
+    return image.width * image.height * len(image.getbands()) * (2 if image.mode == 'I;16' else 1)
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    # Worker processes are waited for by now so their peak counts too
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+def time_call(function, min_time=0.2, min_repeats=3):
+    """Returns the fastest of several calls of function in seconds, repeating for at least min_time seconds."""
+
+    best = float('inf')
+    repeats = 0
+    start = time.perf_counter()
+
+    while repeats < min_repeats or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - call_start)
+        repeats += 1
+
+    return best
+
+def result(kind, name, mode, size_name, seconds, images, nbytes, **extra):
+    return dict(
+        kind=kind,
+        name=name,
+        mode=mode,
+        size=size_name,
+        seconds=seconds,
+        images_per_s=images / seconds if seconds else None,
+        mb_per_s=nbytes / (1 << 20) / seconds if seconds else None,
+        **extra,
+    )
+
+def bench_modifiers(size_names, modes, min_time):
+    results = []
+
+    for size_name in size_names:
+        for mode in modes:
+            image = make_image(mode, SIZES[size_name])
+            image.load()
+
+            for name, make_modifier in MODIFIERS.items():
+                modifier = make_modifier()
+                try:
+                    seconds = time_call(lambda: modifier.apply(image), min_time=min_time)
+                except (ValueError, OSError) as e:
+                    # Not every modifier supports every mode
+                    results.append(dict(kind='modifier', name=name, mode=mode, size=size_name, error=str(e)))
+                    continue
+
+                results.append(result('modifier', name, mode, size_name, seconds, 1, pixel_bytes(image)))
+
+    return results
+
+def write_inputs(folder, mode, size, count):
+    image = make_image(mode, size)
+    extension = FORMATS[mode].lower().replace('jpeg', 'jpg')
+    filenames = []
+
+    for index in range(count):
+        filename = path.join(folder, f'{mode.replace(";", "")}-{index}.{extension}')
+        image.save(filename)
+        filenames.append(filename)
+
+    return filenames, pixel_bytes(image)
+
+def run_chain_case(kind, chain_name, mode, size_name, count, workers):
+    """Runs one chain or batch case, meant to be called in a fresh process so peak RSS only covers this case."""
+
+    # Imported here so that the modifier benchmarks don't pay for it
+    from batch import ImageBatch
+
+    with tempfile.TemporaryDirectory() as folder:
+        inputs = path.join(folder, 'in')
+        outputs = path.join(folder, 'out')
+        os.makedirs(inputs)
+        os.makedirs(outputs)
+        filenames, nbytes = write_inputs(inputs, mode, SIZES[size_name], count)
+
+        batch = ImageBatch()
+        batch.set_modifiers(CHAINS[chain_name]())
+        batch.set_files(filenames)
+        batch.set_save_dest(outputs)
+        batch.incremental = False
+        batch.deduplicate = False # The inputs are copies of one image
+
+        start = time.perf_counter()
+        if kind == 'chain':
+            for filename in filenames:
+                batch.get_processed_image(filename).load()
+        else:
+            batch.process_all(workers=workers)
+        seconds = time.perf_counter() - start
+
+    return result(kind, get_case_name(kind, chain_name, workers), mode, size_name, seconds, count, nbytes * count, workers=workers, peak_rss_mb=peak_rss_mb())
+
+def can_run(chain_name, mode):
+    return mode in ENHANCE_MODES or all(isinstance(modifier, modifiers.GeometryModifier) for modifier in CHAINS[chain_name]())
+
+def get_case_name(kind, chain_name, workers):
+    return chain_name if kind == 'chain' else f'{chain_name}-w{workers}'
+
+def bench_chains(size_names, modes, count, workers):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    cases = [('chain', 1)] + [('batch', 1)] + ([('batch', workers)] if workers > 1 else [])
+
+    for size_name in size_names:
+        for mode in modes:
+            for chain_name in CHAINS:
+                if not can_run(chain_name, mode):
+                    continue
+                for kind, case_workers in cases:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        try:
+                            results.append(executor.submit(run_chain_case, kind, chain_name, mode, size_name, count, case_workers).result())
+                        except (ValueError, OSError) as e:
+                            name = get_case_name(kind, chain_name, case_workers)
+                            results.append(dict(kind=kind, name=name, mode=mode, size=size_name, workers=case_workers, error=str(e)))
+
+    return results
+
+def get_key(entry):
+    return entry['kind'], entry['name'], entry['mode'], entry['size']
+
+def compare(before_filename, after_filename, threshold):
+    """Prints the change in time of every case in both files and returns how many got slower by more than threshold."""
+
+    with open(before_filename) as f:
+        before = {get_key(entry): entry for entry in json.load(f)['results']}
+    with open(after_filename) as f:
+        after = {get_key(entry): entry for entry in json.load(f)['results']}
+
+    regressions = 0
+    for key, entry in after.items():
+        old = before.get(key)
+        if old is None or 'seconds' not in old or 'seconds' not in entry:
+            continue
+
+        change = entry['seconds'] / old['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f'{" ".join(key):<40} {old["seconds"] * 1000:10.2f}ms -> {entry["seconds"] * 1000:10.2f}ms {change:+7.1%}{flag}')
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the modifiers and batch throughput.')
+    parser.add_argument('-o', '--output', help='file to save the results to as JSON')
+    parser.add_argument('--sizes', nargs='+', choices=SIZES, default=list(SIZES))
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--count', type=int, default=8, help='images per chain/batch case')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='workers for the parallel batch cases')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds to spend timing each modifier')
+    parser.add_argument('--skip-chains', action='store_true', help='only time the modifiers on their own')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files instead of benchmarking')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown reported as a regression by --compare (default 0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(*args.compare, args.threshold) else 0
+
+    results = bench_modifiers(args.sizes, args.modes, args.min_time)
+    if not args.skip_chains:
+        results += bench_chains(args.sizes, args.modes, args.count, args.workers)
+
+    for entry in results:
+        if 'error' in entry:
+            print(f'{entry["kind"]:<9}{entry["name"]:<14}{entry["mode"]:<6}{entry["size"]:<8} error: {entry["error"]}')
+        else:
+            rss = f'{entry["peak_rss_mb"]:8.1f}MB' if entry.get('peak_rss_mb') is not None else ''
+            print(f'{entry["kind"]:<9}{entry["name"]:<14}{entry["mode"]:<6}{entry["size"]:<8}{entry["seconds"] * 1000:10.2f}ms'
+                  f'{entry["images_per_s"]:10.1f} img/s{entry["mb_per_s"]:10.1f} MB/s{rss}')
+
+    if args.output:
+        meta = dict(
+            date=datetime.datetime.now().isoformat(timespec='seconds'),
+            python=platform.python_version(),
+            pillow=PIL.__version__,
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+        )
+        with open(args.output, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=4)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
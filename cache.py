@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from os import path
+import os
+import threading
+
+def get_cache_dir(name):
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+    return path.join(base, 'pillowgui', name)
+
+class LRUCache:
+
+    """Keeps at most max_entries values, evicting the least recently used one first. Safe to share between threads.
+
+    If max_bytes is given, sizeof(value) is the size of a value and values are also evicted while their total is
+    larger than max_bytes, except for the most recently used one."""
+
+    def __init__(self, max_entries=8, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            if self.max_bytes is not None:
+                self.total_bytes += self.sizeof(value) - self.sizes.get(key, 0)
+                self.sizes[key] = self.sizeof(value)
+
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self.entries) > 1):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        self.total_bytes -= self.sizes.pop(key, 0)
+        return self.entries.pop(key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+class DiskCache:
+
+    """A folder of cached files ending in suffix, safe to share between threads and processes. Files are written under a
+    temporary name and renamed into place, so no reader sees half a file. The modification time of a file is bumped
+    every time it's used and the least recently used files are deleted once the folder grows past max_bytes."""
+
+    def __init__(self, folder, max_bytes, suffix):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.total_bytes = None # Worked out on the first put
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to worker processes without the lock
+        state = dict(self.__dict__, total_bytes=None)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.Lock())
+
+    def touch(self, cache_path):
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+
+    def put(self, cache_path, write):
+        """Calls write with a temporary path to write the file to and moves it to cache_path."""
+
+        os.makedirs(self.folder, exist_ok=True)
+
+        temp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            write(temp_path)
+            os.replace(temp_path, cache_path)
+            nbytes = path.getsize(cache_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, _, size in self.get_entries())
+            else:
+                self.total_bytes += nbytes
+
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def get_entries(self):
+        """Returns (last used, path, size) for every cached file."""
+
+        entries = []
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if entry.name.endswith(self.suffix):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, entry.path, stat.st_size))
+        except OSError:
+            pass
+        return entries
+
+    def evict(self):
+        """Deletes the least recently used files until the cache is at most 3/4 of max_bytes, so that evicting (which
+        lists the whole folder) doesn't happen on every put."""
+
+        entries = sorted(self.get_entries())
+        self.total_bytes = sum(size for _, _, size in entries)
+
+        for _, cache_path, size in entries:
+            if self.total_bytes <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(cache_path)
+            except OSError: # e.g. mapped by another process on Windows
+                continue
+            self.total_bytes -= size
+
+    def clear(self):
+        with self.lock:
+            for _, cache_path, _ in self.get_entries():
+                try:
+                    os.remove(cache_path)
+                except OSError:
+                    pass
+            self.total_bytes = 0
@@ -0,0 +1,170 @@
+"""Runs a recipe over a batch of images without the GUI (and without importing tkinter).
+
+    python cli.py recipe.json "photos/**/*.jpg" scans/ -o processed --workers 8
+
+Inputs can be files, glob patterns (** matches any number of folders) or folders, which are scanned for supported
+images like File > Open Folder does."""
+
+from glob import glob
+from os import path, cpu_count
+import argparse
+import os
+import sys
+from batch import ImageBatch
+from decodecache import DecodeCache
+from watcher import Watcher
+import pipeline
+import recipe
+import spool
+import tiling
+
+def expand_inputs(inputs, batch):
+    filenames = []
+
+    for pattern in inputs:
+        if path.isdir(pattern):
+            filenames += batch.scan_folder(pattern)
+        else:
+            matches = sorted(glob(pattern, recursive=True))
+            if not matches:
+                print(f'warning: {pattern} matched no files', file=sys.stderr)
+            filenames += [match for match in matches if path.isfile(match)]
+
+    # Keep the first occurrence of files matched by several inputs
+    return list(dict.fromkeys(filenames))
+
+def parse_encoder_option(text):
+    """Parses FORMAT.OPTION=VALUE, e.g. jpeg.quality=90, into ('JPEG', 'quality', 90)."""
+
+    name, sep, value = text.partition('=')
+    format, dot, option = name.partition('.')
+    if not sep or not dot or not format or not option:
+        raise argparse.ArgumentTypeError(f'expected FORMAT.OPTION=VALUE, got {text!r}')
+
+    if value.lower() in ('true', 'false'):
+        value = value.lower() == 'true'
+    else:
+        for type_ in (int, float):
+            try:
+                value = type_(value)
+                break
+            except ValueError:
+                pass
+
+    return format.upper(), option, value
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Apply a PillowGUI recipe to a batch of images.')
+    parser.add_argument('recipe', help='recipe exported from the GUI (.json or .toml)')
+    parser.add_argument('inputs', nargs='+', help='image files, glob patterns or folders')
+    parser.add_argument('-o', '--output', required=True, help='folder to save the processed images to')
+    parser.add_argument('-w', '--workers', type=int, default=cpu_count() or 1, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-e', '--encoder-option', type=parse_encoder_option, action='append', default=[], metavar='FORMAT.OPTION=VALUE',
+                        help='pass an option to the encoder of a format, e.g. jpeg.quality=90 or png.optimize=true (can be repeated)')
+    parser.add_argument('--io-workers', type=int, default=pipeline.IO_WORKERS, help='threads encoding and writing outputs when processing on one worker (default: %(default)s)')
+    parser.add_argument('--memory-budget', type=int, default=pipeline.MEMORY_BUDGET >> 20, metavar='MB', help='megabytes of images to hold at once when processing on one worker (default: %(default)s)')
+    parser.add_argument('--tile-size', type=int, default=tiling.TILE_SIZE, help='process very large images in tiles of this size where possible, 0 never tiles (default: %(default)s)')
+    parser.add_argument('--no-draft', action='store_true', help='always decode images at full resolution')
+    parser.add_argument('--decode-cache', nargs='?', const='', metavar='DIR',
+                        help='keep the decoded pixels of JPEG 2000, EPS and TIFF files in DIR (default: the user cache folder) so later runs skip decoding them')
+    parser.add_argument('--decode-cache-size', type=int, default=4096, metavar='MB', help='megabytes the decode cache may take up (default: %(default)s)')
+    parser.add_argument('--profile', action='store_true', help='print how long each stage (decode, every modifier, save) took')
+    parser.add_argument('--trace', metavar='FILE', help='write the stages of the run to FILE in the Chrome trace event format (implies --profile)')
+    parser.add_argument('--no-dedupe', action='store_true', help='process every file even if another file has the same content')
+    parser.add_argument('--copy-duplicates', action='store_true', help='copy the outputs of files with the same content rather than hard linking them')
+    parser.add_argument('--spool', help='hand the files to the workers serving this shared folder (see spool.py) instead of processing them here')
+    parser.add_argument('--local-workers', type=int, default=0, metavar='N', help='with --spool, also start N worker processes on this host')
+    parser.add_argument('--unit-size', type=int, default=16, help='with --spool, number of files in each unit of work (default: %(default)s)')
+    parser.add_argument('--watch', action='store_true', help='keep running and process images as they arrive in the input folders (see watcher.py)')
+    parser.add_argument('--max-delay', type=float, default=0.5, metavar='SECONDS',
+                        help='with --watch, longest time a new image waits for others to be processed with (default: %(default)s)')
+    parser.add_argument('--max-batch', type=int, default=64, help='with --watch, most images processed together (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='process every file, even those the output folder\'s manifest says are up to date')
+    return parser
+
+def watch(args, batch):
+    folders = [path.abspath(folder) for folder in args.inputs]
+    for folder in folders:
+        if not path.isdir(folder):
+            print(f'error: --watch needs folders, {folder} isn\'t one', file=sys.stderr)
+            return 2
+        if folder == path.abspath(args.output):
+            print('error: the output folder can\'t be watched, outputs would be processed again', file=sys.stderr)
+            return 2
+
+    def report(results):
+        print(f'Processed {len(results)} files | {watcher.get_status()}', flush=True)
+
+    watcher = Watcher(batch, folders, max_delay=args.max_delay, max_batch=max(1, args.max_batch), workers=batch.workers, on_burst=report)
+    print(f'Watching {", ".join(folders)} (Ctrl+C stops)', flush=True)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+    print(watcher.get_status())
+    if batch.profile:
+        print(batch.profiler.get_summary())
+    return 0
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    batch = ImageBatch()
+
+    try:
+        batch.set_modifiers(recipe.load(args.recipe))
+    except (OSError, ValueError) as e:
+        print(f'error: could not load {args.recipe}: {e}', file=sys.stderr)
+        return 2
+
+    if not args.watch:
+        batch.set_files(expand_inputs(args.inputs, batch))
+        if not batch.filenames:
+            print('error: no input files', file=sys.stderr)
+            return 2
+
+    os.makedirs(args.output, exist_ok=True)
+    batch.set_save_dest(args.output)
+    batch.set_workers(args.workers)
+    batch.draft_decode = not args.no_draft
+    batch.memory_budget = args.memory_budget << 20
+    batch.io_workers = max(1, args.io_workers)
+    for format, option, value in args.encoder_option:
+        batch.encoder_options.setdefault(format, {})[option] = value
+    batch.tile_size = args.tile_size or None
+    if args.decode_cache is not None:
+        batch.decode_cache = DecodeCache(args.decode_cache or None, max_bytes=args.decode_cache_size << 20)
+    batch.incremental = not args.force
+    batch.deduplicate = not args.no_dedupe
+    batch.link_duplicates = not args.copy_duplicates
+    batch.profile = args.profile or bool(args.trace)
+    batch.trace_file = args.trace
+
+    if args.watch:
+        return watch(args, batch)
+
+    coordinator = None
+    if args.spool:
+        os.makedirs(args.spool, exist_ok=True)
+        local_workers = []
+        coordinator = spool.Coordinator(args.spool, unit_size=max(1, args.unit_size),
+                                        on_submit=lambda job: local_workers.extend(spool.start_local_workers(job, args.local_workers)))
+
+    try:
+        results = batch.process_all(coordinator=coordinator)
+    finally:
+        if coordinator is not None:
+            for process in local_workers:
+                process.wait()
+
+    skipped = len(batch.filenames) - len(results)
+    print(f'Processed {len(results)} files into {args.output}' + (f' ({skipped} already up to date)' if skipped else ''))
+
+    if coordinator is not None:
+        print(coordinator.get_summary())
+    if batch.profile:
+        print(batch.profiler.get_summary())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
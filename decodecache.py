@@ -0,0 +1,159 @@
+"""An on-disk cache of decoded pixels for formats that are slow to decode, so that the second time a source is
+previewed or processed it's mapped into memory rather than decoded again. Doesn't depend on tkinter.
+
+Each entry is a file named after a hash of the source's absolute path, size, modification time and the mode, size and
+JPEG 2000 reduce level it's decoded at (which a reduced decode changes), so a changed source simply misses. An entry is a header followed by
+the raw pixels:
+
+    MAGIC, the length of the JSON header (8 bytes, little endian), the header (mode, size, palette and info), padding
+    to a multiple of ALIGNMENT, pixels as Image.tobytes() returns them
+
+Images in the modes Image.frombuffer can map (L, P, RGBA, CMYK, ...) use the mapped file as their memory, other modes
+(e.g. RGB, which Pillow keeps as 4 bytes a pixel) are unpacked from it in one pass."""
+
+from PIL import Image
+from os import path
+import base64
+import hashlib
+import json
+import mmap
+import os
+from cache import DiskCache
+from profiling import pixel_bytes
+import cache
+
+# Formats whose decoders are slow enough that reading the raw pixels back is faster (JPEGs are left to the draft decode)
+SLOW_FORMATS = ('JPEG2000', 'EPS', 'TIFF')
+
+MAGIC = b'PGRAW\x00\x01\x00'
+ALIGNMENT = 64
+
+def get_cache_dir():
+    return cache.get_cache_dir('decoded')
+
+def encode_info(info):
+    """Returns the entries of an image's info that survive JSON, with bytes and tuples tagged."""
+
+    encoded = {}
+    for key, value in info.items():
+        if isinstance(value, bytes):
+            encoded[key] = ['bytes', base64.b64encode(value).decode('ascii')]
+        elif isinstance(value, tuple) and all(isinstance(item, (int, float)) for item in value):
+            encoded[key] = ['tuple', list(value)]
+        elif isinstance(value, (str, int, float, bool)):
+            encoded[key] = ['value', value]
+    return encoded
+
+def decode_info(encoded):
+    info = {}
+    for key, (kind, value) in encoded.items():
+        if kind == 'bytes':
+            info[key] = base64.b64decode(value)
+        elif kind == 'tuple':
+            info[key] = tuple(value)
+        else:
+            info[key] = value
+    return info
+
+def write_entry(filename, image):
+    header = dict(mode=image.mode, size=image.size, info=encode_info(image.info))
+    if image.palette is not None and image.mode in ('P', 'PA'):
+        palette_mode = image.palette.mode
+        header['palette'] = [palette_mode, base64.b64encode(bytes(image.getpalette(palette_mode))).decode('ascii')]
+
+    header = json.dumps(header).encode()
+    offset = len(MAGIC) + 8 + len(header)
+    padding = -offset % ALIGNMENT
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC + len(header).to_bytes(8, 'little') + header + bytes(padding))
+        f.write(image.tobytes())
+
+def read_entry(filename):
+    """Returns the image cached in filename, backed by a read-only mapping of the file. Raises OSError or ValueError if
+    it isn't a complete entry."""
+
+    with open(filename, 'rb') as f:
+        # The mapping stays open after the file is closed, for as long as the image uses it
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapping[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'not a decoded image: {filename}')
+
+    length = int.from_bytes(mapping[len(MAGIC):len(MAGIC) + 8], 'little')
+    start = len(MAGIC) + 8
+    header = json.loads(mapping[start:start + length])
+    offset = start + length + (-(start + length) % ALIGNMENT)
+
+    mode, size = header['mode'], tuple(header['size'])
+    image = Image.frombuffer(mode, size, memoryview(mapping)[offset:], 'raw', mode, 0, 1)
+
+    if 'palette' in header:
+        palette_mode, palette = header['palette']
+        image.putpalette(base64.b64decode(palette), palette_mode)
+    image.info = decode_info(header['info'])
+    return image
+
+def get_reduce(image):
+    # The reduce level JPEG 2000 decodes at. The plugin's reduce shadows Image.reduce, which it returns when it's 0.
+    reduce = getattr(image, 'reduce', 0)
+    return reduce if isinstance(reduce, int) else 0
+
+def get_loaded_size(image):
+    """Returns the size image (opened but not loaded) will have once it's loaded. A JPEG 2000 reduce only changes the
+    size in load, unlike a JPEG draft."""
+
+    reduce = get_reduce(image)
+    if not reduce:
+        return image.size
+    power = 1 << reduce
+    return tuple(int((size + (power >> 1)) / power) for size in image.size)
+
+class DecodeCache(DiskCache):
+    def __init__(self, folder=None, max_bytes=4 << 30, formats=SLOW_FORMATS):
+        super().__init__(folder or get_cache_dir(), max_bytes, '.raw')
+        self.formats = formats
+
+    def can_cache(self, image):
+        return image.format in self.formats and isinstance(image.filename, str) and bool(image.filename)
+
+    def get_path(self, image):
+        """Returns the path the decoded pixels of image (opened but not loaded) are cached at, or None if its file
+        can't be read."""
+
+        try:
+            stat = os.stat(image.filename)
+        except OSError:
+            return None
+
+        width, height = get_loaded_size(image)
+        key = f'{path.abspath(image.filename)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{image.mode}\0{width}x{height}\0{get_reduce(image)}'
+        return path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + '.raw')
+
+    def load(self, image):
+        """Loads image (opened but not loaded, possibly set to decode at a reduced size) and closes its file, like
+        pipeline.load_image. Images of slow formats come from the cache if they're in it and are added to it if they
+        aren't. Images from the cache are read-only, like those of Image.frombuffer."""
+
+        cache_path = self.get_path(image) if self.can_cache(image) else None
+
+        if cache_path is not None:
+            try:
+                cached = read_entry(cache_path)
+            except (OSError, ValueError, KeyError):
+                cached = None
+
+            # Pixels decoded at another size than the one asked for are never handed out
+            if cached is not None and cached.size == get_loaded_size(image):
+                image.close()
+                self.touch(cache_path)
+                return cached
+
+        with image:
+            image.load()
+
+        # Images that would take up a large part of the cache aren't worth evicting everything else for
+        if cache_path is not None and pixel_bytes(image.mode, image.size) <= self.max_bytes // 4:
+            self.put(cache_path, lambda temp_path: write_entry(temp_path, image))
+
+        return image
@@ -0,0 +1,64 @@
+"""Finds inputs with identical content so a batch processes each only once, and puts copies of the output in place
+for the others."""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+import os
+import threading
+from manifest import file_digest
+
+def group_identical(filenames, workers=4):
+    """Returns lists of the files with the same content, ordered by their first file, with every file in exactly one
+    list. Only files with the same size as another are read, on a pool of workers threads (hashlib releases the GIL)."""
+
+    sizes = {}
+    for filename in filenames:
+        try:
+            sizes[filename] = os.stat(filename).st_size
+        except OSError:
+            sizes[filename] = None
+
+    counts = Counter(size for size in sizes.values() if size is not None)
+    candidates = [filename for filename in dict.fromkeys(filenames) if counts[sizes[filename]] > 1]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = dict(zip(candidates, executor.map(file_digest, candidates)))
+
+    groups = {}
+    for filename in filenames:
+        if filename in digests:
+            key = ('digest', sizes[filename], digests[filename])
+        else:
+            key = ('file', filename)
+        groups.setdefault(key, []).append(filename)
+
+    return list(groups.values())
+
+def materialize(outfile, duplicate_outfile, link=True):
+    """Puts the output of a file at duplicate_outfile as well, as a hard link if link is set and the file system
+    supports it and as a copy otherwise. Like pipeline.write_file, duplicate_outfile is replaced in one step."""
+
+    if path.abspath(outfile) == path.abspath(duplicate_outfile):
+        return
+
+    os.makedirs(path.dirname(duplicate_outfile) or '.', exist_ok=True)
+    temp_filename = f'{duplicate_outfile}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    try:
+        if link:
+            try:
+                os.link(outfile, temp_filename)
+            except OSError: # e.g. another file system or FAT
+                link = False
+        if not link:
+            with open(outfile, 'rb') as src, open(temp_filename, 'wb') as dst:
+                for chunk in iter(lambda: src.read(1 << 20), b''):
+                    dst.write(chunk)
+        os.replace(temp_filename, duplicate_outfile)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
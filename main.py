@@ -1,131 +1,21 @@
 from PIL import Image, ImageEnhance, ImageTk
-from tkinter import Tk, Menu, Button, Label, Listbox, Canvas, Scrollbar, Toplevel, Scale, END, BooleanVar
-from tkinter.filedialog import askopenfilenames, askdirectory
-import modifiers
-from os import path
-from glob import glob
-from widgets import FilePane, SliderDialog, ResizeImageDialog, CropImageDialog
-
-# https://pillow.readthedocs.io/en/5.1.x/handbook/image-file-formats.html#fully-supported-formats
-SUPPORTED_FILE_EXTENSIONS = (
-                             'bmp', 'dib', 
-                             'eps', 'epsf', 'epsi',
-                             'gif', 
-                             'icns', 
-                             'ico', 
-                             'im', 
-                             'jpg', 'jpeg', 'jpe', 'jif', 'jfif', 'jfi',
-                             'jp2', 'j2k', 'jpf', 'jpx', 'jpm', 'mj2',
-                             'msp',
-                             'pcx',
-                             'png',
-                             'pbm', 'pgm', 'ppm', 'pnm',
-                             '.sgi',
-                             'tiff', 'tif',
-                             'webp',
-                             'xbm'
-                             )
-
-class ImageBatch:
-    def __init__(self):
-        self.filenames = []
-        self.modifiers = [] # What modifiers to apply in the order they should be applied
-        self.confirmed_mod_count = 0 # Records the number of confirmed modifiers
-        self.save_dest = "" # If None we overwrite the original images (TBD)
-        self.im_width = 1.0
-        self.im_height = 1.0
-        self.maintain_aspect_ratio = True
-        self.primary_dimension = 'width'
-        self.anchor = 'Top'
-        self.color = 1.0
-        self.contrast = 1.0
-        self.brightness = 1.0
-        self.sharpness = 1.0
-
-    def select_files(self):
-        self.filenames = askopenfilenames()
-        if self.filenames:
-            self.preview_image = self.filenames[0]
-
-    def select_folders(self):
-        # askdirectory only allows one directory to be chosen
-        dir_ = askdirectory()
-        if dir_:
-            self.filenames = []
-
-            # From https://stackoverflow.com/a/40755802/11628429
-            for ext in SUPPORTED_FILE_EXTENSIONS:
-                self.filenames += glob(dir_ + "/**/*." + ext, recursive=True)
-
-    def select_save_dest(self):
-        dir_ = askdirectory()
-        if dir_:
-            self.save_dest = dir_
-
-    def get_processed_image(self, filename):
-        im = Image.open(filename)
-
-        for modifier in self.modifiers:
-            im = modifier.apply(im)
-
-        return im
-
-    def process_all(self):
-        for filename in self.filenames:
-            processed_im = self.get_processed_image(filename)
-            outfile = f'{self.save_dest}/{path.split(filename)[1]}'
-            processed_im.save(outfile)
-
-    def get_tk_image(self, filename):
-        return ImageTk.PhotoImage(self.get_processed_image(filename))
-
-    def confirm_modifier(self):
-        self.confirmed_mod_count += 1
-
-    def cancel_modifier(self):
-        try:
-            del self.modifiers[self.confirmed_mod_count]
-        except IndexError:
-            pass
-
-    def add_modifier(self, modifier):
-        try:
-            self.modifiers[self.confirmed_mod_count] = modifier
-        except IndexError:
-            self.modifiers.append(modifier)
-
-    def set_image_size(self, width, height, maintain_aspect_ratio, primary_dimension='width'):
-        self.im_width = width
-        self.im_height = height
-        self.maintain_aspect_ratio = maintain_aspect_ratio
-        self.primary_dimension = primary_dimension
-        self.add_modifier(modifiers.ResizeModifier(self.im_width, self.im_height, self.maintain_aspect_ratio, primary_dimension=self.primary_dimension))
-
-    def set_image_crop(self, width, height, maintain_aspect_ratio, primary_dimension='width', anchor='Top'):
-        self.im_width = width
-        self.im_height = height
-        self.maintain_aspect_ratio = maintain_aspect_ratio
-        self.primary_dimension = primary_dimension
-        self.anchor = anchor
-        modifier = modifiers.CropModifier(self.im_width, self.im_height, self.maintain_aspect_ratio, primary_dimension=self.primary_dimension, anchor=self.anchor)
-        self.add_modifier(modifier)
-
-    def set_color(self, value):
-        self.color = float(value)
-        self.add_modifier(modifiers.ColorModifier(self.color))
-
-    def set_contrast(self, value):
-        self.contrast = float(value)
-        self.add_modifier(modifiers.ContrastModifier(self.contrast))
-
-    def set_brightness(self, value):
-        self.brightness = float(value)
-        self.add_modifier(modifiers.BrightnessModifier(self.brightness))
-
-    def set_sharpness(self, value):
-        self.sharpness = float(value)
-        self.add_modifier(modifiers.SharpnessModifier(self.sharpness))
-
+from tkinter import Tk, Menu, Button, Label, Listbox, Canvas, Scrollbar, Toplevel, Scale, END, BooleanVar, IntVar
+from tkinter.filedialog import askopenfilenames, askopenfilename, asksaveasfilename, askdirectory
+from tkinter.messagebox import showinfo, showerror
+import planner
+import recipe
+from os import cpu_count
+from batch import ImageBatch
+from widgets import FilePane, SliderDialog, ResizeImageDialog, CropImageDialog, ProgressDialog
+from background import Dispatcher, LatestOnlyWorker, StreamTask, Task, WorkQueue
+from profiling import Progress
+from decodecache import DecodeCache
+from thumbnails import ThumbnailCache
+
+# Zoom levels of the preview, and the factor zooming in or out changes it by
+MIN_ZOOM = 1 / 16
+MAX_ZOOM = 16
+ZOOM_STEP = 1.25
 
 class GUI:
     def __init__(self):
@@ -135,12 +25,37 @@ class GUI:
         self.root.geometry("800x600")
         self.files_selected = False
         self.preview_filename = ""
+        self.prefetch_count = 3 # Number of files ahead in the file pane's direction of travel whose previews are rendered in advance
 
         self.filepane_open = BooleanVar(value=True)
-        self.filepane = FilePane(self.root, on_selection=[self.set_preview], on_close=[self.on_filepane_close])
+        self.workers = IntVar(value=1)
+        self.proxy_preview = BooleanVar(value=True)
+        self.profile = BooleanVar(value=False)
+        self.cache_decoded = BooleanVar(value=True)
 
         self.batch = ImageBatch()
 
+        # Sources in slow formats (JPEG 2000, EPS, TIFF) are decoded once and mapped from disk after that
+        self.decode_cache = DecodeCache()
+        self.batch.decode_cache = self.decode_cache
+
+        # Previews are rendered on a background thread so that dragging a slider never blocks the UI
+        self.dispatcher = Dispatcher(self.root)
+        self.preview_worker = LatestOnlyWorker(self.dispatcher, name='preview')
+        self.prefetch_queue = WorkQueue(self.dispatcher, lambda job: job(), lambda job, image: None, name='prefetch')
+        self.prefetch_pending = False
+        self.scan = None
+
+        # Runs process the files in the background while a ProgressDialog shows how far they've got
+        self.run_task = None
+        self.progress = None
+        self.progress_dialog = None
+
+        # Thumbnails are cached on disk and made in the background as rows of the file pane come into view
+        self.thumbnail_cache = ThumbnailCache()
+        self.thumbnail_queue = WorkQueue(self.dispatcher, self.thumbnail_cache.get, self.set_thumbnail, name='thumbnails')
+        self.filepane = FilePane(self.root, on_selection=[self.set_preview], on_close=[self.on_filepane_close], thumbnails=self.thumbnail_queue)
+
         # Create a toplevel menu (from http://effbot.org/tkinterbook/menu.htm)
         self.menubar = Menu(self.root)
 
@@ -148,8 +63,17 @@ class GUI:
         self.filemenu = Menu(self.menubar, tearoff=0)
         self.filemenu.add_command(label="Open File...", command=self.select_files)
         self.filemenu.add_command(label="Open Folder...", command=self.select_folders)
+        self.filemenu.add_command(label="Stop scan", command=self.stop_scan, state="disabled")
         self.filemenu.add_command(label="Set save destination", command=self.select_save_dest)
         self.filemenu.add_separator()
+        self.filemenu.add_command(label="Import recipe...", command=self.import_recipe)
+        self.filemenu.add_command(label="Export recipe...", command=self.export_recipe)
+
+        self.workersmenu = Menu(self.filemenu, tearoff=0)
+        for count in sorted({1, 2, 4, 8, 16, cpu_count() or 1}):
+            self.workersmenu.add_radiobutton(label=str(count), value=count, variable=self.workers, command=self.set_workers)
+        self.filemenu.add_cascade(label="Workers", menu=self.workersmenu)
+        self.filemenu.add_separator()
         self.filemenu.add_command(label="Exit", command=self.root.quit)
         self.menubar.add_cascade(label="File", menu=self.filemenu)
 
@@ -167,6 +91,23 @@ class GUI:
 
         self.viewmenu = Menu(self.menubar, tearoff=0)
         self.viewmenu.add_checkbutton(label="Files", onvalue=True, offvalue=False, variable=self.filepane_open, command=self.toggle_filepane)
+        self.viewmenu.add_checkbutton(label="Proxy preview", onvalue=True, offvalue=False, variable=self.proxy_preview, command=self.update_preview)
+        self.viewmenu.add_checkbutton(label="Cache decoded images", onvalue=True, offvalue=False, variable=self.cache_decoded, command=self.toggle_decode_cache)
+        self.viewmenu.add_command(label="Processing plan", command=self.show_plan)
+        self.viewmenu.add_separator()
+        self.viewmenu.add_command(label="Zoom in", accelerator="Ctrl++", command=self.zoom_in)
+        self.viewmenu.add_command(label="Zoom out", accelerator="Ctrl+-", command=self.zoom_out)
+        self.viewmenu.add_command(label="Actual size", accelerator="Ctrl+0", command=self.zoom_actual_size)
+        self.viewmenu.add_command(label="Zoom to fit", command=self.zoom_to_fit)
+        self.root.bind('<Control-plus>', self.zoom_in)
+        self.root.bind('<Control-equal>', self.zoom_in)
+        self.root.bind('<Control-minus>', self.zoom_out)
+        self.root.bind('<Control-0>', self.zoom_actual_size)
+        self.viewmenu.add_separator()
+        self.viewmenu.add_checkbutton(label="Profile", onvalue=True, offvalue=False, variable=self.profile, command=self.toggle_profile)
+        self.viewmenu.add_command(label="Profile summary", command=self.show_profile_summary)
+        self.viewmenu.add_command(label="Save trace...", command=self.save_trace)
+        self.viewmenu.add_command(label="Clear profile", command=self.clear_profile)
         # self.viewmenu.add_command(label="Files", command=self.adjust_color)
         self.menubar.add_cascade(label="View", menu=self.viewmenu)
 
@@ -177,7 +118,7 @@ class GUI:
         # menubar.add_cascade(label="Effects", menu=effectsmenu)
 
         self.menubar.add_command(label=":", state='disabled')
-        self.menubar.add_command(label='Run', command=self.batch.process_all)
+        self.menubar.add_command(label='Run', command=self.run)
 
         # Display the menu
         self.root.config(menu=self.menubar)
@@ -185,16 +126,24 @@ class GUI:
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=1)
 
-        self.canvas = Canvas(self.root)
-        self.canvas.grid(row=0, column=0)
+        # Only the part of the preview that is visible is drawn, into one PhotoImage the size of the canvas which is
+        # pasted into rather than replaced while the size stays the same
+        self.canvas = Canvas(self.root, highlightthickness=0)
+        self.canvas.grid(row=0, column=0, sticky="nsew")
+        self.preview = None # The rendered preview, at its own resolution
+        self.zoom = 1.0
         self.image = None
         self.imagesprite = self.canvas.create_image(0, 0, image=None, anchor='nw')
+        self.canvas.bind('<Configure>', lambda event: self.draw_preview())
+        self.canvas.bind('<MouseWheel>', lambda event: self.yview('scroll', -event.delta // 120, 'units'))
+        self.canvas.bind('<Button-4>', lambda event: self.yview('scroll', -1, 'units'))
+        self.canvas.bind('<Button-5>', lambda event: self.yview('scroll', 1, 'units'))
 
         self.sbarV = Scrollbar(self.root, orient='vertical')
         self.sbarH = Scrollbar(self.root, orient='horizontal')
 
-        self.sbarV.config(command=self.canvas.yview)
-        self.sbarH.config(command=self.canvas.xview)
+        self.sbarV.config(command=self.yview)
+        self.sbarH.config(command=self.xview)
 
         self.canvas.config(yscrollcommand=self.sbarV.set)
         self.canvas.config(xscrollcommand=self.sbarH.set)
@@ -202,6 +151,10 @@ class GUI:
         self.sbarV.grid(row=0, column=1, sticky="ns")
         self.sbarH.grid(row=1, column=0, sticky="ew")
 
+        # Shows the mean time of each stage while profiling
+        self.statusbar = Label(self.root, text="", anchor='w')
+        self.update_status()
+
         self.disable_editing()
 
         self.root.mainloop()
@@ -212,6 +165,9 @@ class GUI:
         else:
             self.filepane.hide()
 
+    def set_thumbnail(self, filename, image):
+        self.filepane.set_thumbnail(filename, image)
+
     def on_filepane_close(self):
         self.filepane_open.set(False)
 
@@ -226,9 +182,10 @@ class GUI:
         self.menubar.entryconfig("Run", state="disabled")
 
     def select_files(self):
-        self.batch.select_files()
+        self.batch.set_files(askopenfilenames())
 
         if self.batch.filenames:
+            self.stop_scan()
             self.filepane.set_items(self.batch.filenames)
             self.update_preview()
             self.enable_editing()
@@ -236,41 +193,250 @@ class GUI:
             self.disable_editing()
 
     def select_folders(self):
-        self.batch.select_folders()
+        # askdirectory only allows one directory to be chosen
+        dir_ = askdirectory()
+        if not dir_:
+            return
 
-        if self.batch.filenames:
-            self.filepane.set_items(self.batch.filenames)
-            self.update_preview()
+        self.stop_scan()
+        self.batch.set_files([])
+        self.filepane.set_items(self.batch.filenames)
+        self.disable_editing()
+
+        # The folder is scanned in the background and the file pane filled in as files are found
+        self.filemenu.entryconfig("Stop scan", state="normal")
+        self.scan = StreamTask(self.dispatcher, lambda cancelled: self.batch.scan_folder(dir_, cancelled), self.add_scanned_files, on_done=self.on_scan_done, name='scan')
+
+    def add_scanned_files(self, filenames):
+        first_files = not self.batch.filenames
+        self.batch.add_files(filenames)
+        self.filepane.update()
+
+        if first_files:
+            self.filepane.select_index(0)
             self.enable_editing()
-        else:
-            self.disable_editing()
+
+    def on_scan_done(self):
+        self.filemenu.entryconfig("Stop scan", state="disabled")
+
+    def stop_scan(self):
+        if self.scan is not None:
+            self.scan.cancel()
+            self.scan = None
+        self.filemenu.entryconfig("Stop scan", state="disabled")
 
     def select_save_dest(self):
-        self.batch.select_save_dest()
+        dir_ = askdirectory()
+        if dir_:
+            self.batch.set_save_dest(dir_)
+
+    def export_recipe(self):
+        filename = asksaveasfilename(defaultextension='.json', filetypes=[('JSON recipe', '*.json'), ('TOML recipe', '*.toml')])
+        if filename:
+            recipe.save(filename, self.batch.modifiers)
+
+    def import_recipe(self):
+        filename = askopenfilename(filetypes=[('Recipes', '*.json *.toml')])
+        if not filename:
+            return
+
+        try:
+            self.batch.set_modifiers(recipe.load(filename))
+        except (OSError, ValueError) as e:
+            showerror('Import recipe', f'Could not load {filename}: {e}', parent=self.root)
+            return
+
+        if self.preview_filename:
+            self.on_modifiers_change()
+
+    def toggle_decode_cache(self):
+        self.batch.decode_cache = self.decode_cache if self.cache_decoded.get() else None
+
+    def toggle_profile(self):
+        self.batch.profile = self.profile.get()
+        if self.batch.profile:
+            self.statusbar.grid(row=2, column=0, columnspan=2, sticky="ew")
+        else:
+            self.statusbar.grid_remove()
+
+    def update_status(self):
+        if self.batch.profile:
+            self.statusbar.config(text=self.batch.profiler.get_status())
+        self.root.after(500, self.update_status)
+
+    def show_profile_summary(self):
+        showinfo('Profile summary', self.batch.profiler.get_summary(), parent=self.root)
+
+    def save_trace(self):
+        filename = asksaveasfilename(defaultextension='.json', filetypes=[('Chrome trace', '*.json')])
+        if filename:
+            self.batch.profiler.write_trace(filename)
+
+    def clear_profile(self):
+        self.batch.profiler.clear()
+
+    def run(self):
+        if self.run_task is not None:
+            return
+
+        # The file list is copied since scanning a folder extends it
+        filenames = list(self.batch.filenames)
+        progress = self.progress = Progress()
+
+        self.menubar.entryconfig('Run', state='disabled')
+        self.progress_dialog = ProgressDialog(self.root, on_cancel=[self.cancel_run])
+        self.run_task = Task(self.dispatcher, lambda cancelled: self.batch.process_all(filenames=filenames, progress=progress, cancelled=cancelled),
+                             self.on_run_done, name='run')
+        self.update_progress()
+
+    def update_progress(self):
+        if self.run_task is None:
+            return
+        self.progress_dialog.update(self.progress.done, self.progress.total, self.progress.get_status())
+        self.root.after(200, self.update_progress)
+
+    def cancel_run(self):
+        if self.run_task is not None:
+            self.run_task.cancel()
+
+    def on_run_done(self, results, error):
+        cancelled = self.run_task.cancelled.is_set()
+        status = self.progress.get_status()
+        self.run_task = None
+        self.progress_dialog.close()
+        self.menubar.entryconfig('Run', state='normal')
+
+        if error is not None:
+            showerror('Run', f'Processing failed: {error}', parent=self.root)
+        elif cancelled:
+            showinfo('Run', f'Cancelled after {len(results)} of {self.progress.total} files', parent=self.root)
+        else:
+            showinfo('Run', f'Processed {len(results)} files\n{status}', parent=self.root)
+
+    def set_workers(self):
+        self.batch.set_workers(self.workers.get())
 
     def set_preview(self, filename):
         self.preview_filename = filename
+        self.prefetch_pending = True
         self.update_preview()
 
+    def prefetch(self):
+        """Renders the previews of the next files in the direction of travel in the background, after the preview of
+        the selected file so that they don't hold it up."""
+
+        filenames = self.filepane.get_following(self.prefetch_count)
+        self.prefetch_queue.replace([self.batch.get_preview_job(filename, self.get_preview_size()) for filename in filenames])
+
+    def on_modifiers_change(self, *args):
+        # Previews rendered in advance with the old modifiers are no use any more
+        self.prefetch_queue.clear()
+        self.batch.discard_rendered_previews()
+        self.update_preview()
+
+    def get_preview_size(self):
+        # Proxy previews are rendered at (at most) screen size regardless of the size of the source
+        if self.proxy_preview.get():
+            return self.root.winfo_screenwidth(), self.root.winfo_screenheight()
+        return None
+
     def update_preview(self, *args, **kwargs):
-        self.image = self.batch.get_tk_image(self.preview_filename)
-        self.canvas.itemconfig(self.imagesprite, image=self.image)
-        image_size = self.image.width(), self.image.height()
-        self.canvas.configure(width=image_size[0], height=image_size[1])
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+        job = self.batch.get_preview_job(self.preview_filename, self.get_preview_size())
+        self.preview_worker.submit(job, self.show_preview)
+
+    def show_preview(self, image):
+        self.preview = image
+        self.draw_preview()
+
+        if self.prefetch_pending:
+            self.prefetch_pending = False
+            self.prefetch()
+
+    def draw_preview(self):
+        """Draws the part of the preview that is visible at the current zoom."""
+
+        if self.preview is None:
+            return
+
+        zoomed_width = max(1, round(self.preview.width * self.zoom))
+        zoomed_height = max(1, round(self.preview.height * self.zoom))
+        self.canvas.configure(scrollregion=(0, 0, zoomed_width, zoomed_height))
+
+        left = max(0, int(self.canvas.canvasx(0)))
+        top = max(0, int(self.canvas.canvasy(0)))
+        width = min(self.canvas.winfo_width(), zoomed_width - left)
+        height = min(self.canvas.winfo_height(), zoomed_height - top)
+        if width <= 0 or height <= 0:
+            return
+
+        # The zoomed size is rounded, so the edge of the view can map to just past the edge of the preview
+        box = (min(left / self.zoom, self.preview.width), min(top / self.zoom, self.preview.height),
+               min((left + width) / self.zoom, self.preview.width), min((top + height) / self.zoom, self.preview.height))
+        resample = Image.NEAREST if self.zoom >= 1 else Image.BILINEAR
+        view = self.preview.resize((width, height), resample, box=box)
+
+        if self.image is not None and (self.image.width(), self.image.height()) == view.size:
+            self.image.paste(view)
+        else:
+            self.image = ImageTk.PhotoImage(view)
+            self.canvas.itemconfig(self.imagesprite, image=self.image)
+        self.canvas.coords(self.imagesprite, left, top)
+
+    def xview(self, *args):
+        self.canvas.xview(*args)
+        self.draw_preview()
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.draw_preview()
+
+    def set_zoom(self, zoom):
+        if self.preview is None:
+            return
+
+        # Keep the point in the middle of the canvas where it is
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        center_x = (self.canvas.canvasx(0) + width / 2) / self.zoom
+        center_y = (self.canvas.canvasy(0) + height / 2) / self.zoom
+
+        self.zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        zoomed_width, zoomed_height = self.preview.width * self.zoom, self.preview.height * self.zoom
+        self.canvas.configure(scrollregion=(0, 0, zoomed_width, zoomed_height))
+        self.canvas.xview_moveto(max(0, center_x * self.zoom - width / 2) / zoomed_width)
+        self.canvas.yview_moveto(max(0, center_y * self.zoom - height / 2) / zoomed_height)
+        self.draw_preview()
+
+    def zoom_in(self, *args):
+        self.set_zoom(self.zoom * ZOOM_STEP)
+
+    def zoom_out(self, *args):
+        self.set_zoom(self.zoom / ZOOM_STEP)
+
+    def zoom_actual_size(self, *args):
+        self.set_zoom(1.0)
+
+    def zoom_to_fit(self, *args):
+        if self.preview is not None:
+            self.set_zoom(min(self.canvas.winfo_width() / self.preview.width, self.canvas.winfo_height() / self.preview.height))
+
+    def show_plan(self):
+        if not self.preview_filename:
+            return
+        steps = self.batch.get_plan(self.preview_filename)
+        showinfo('Processing plan', planner.describe(steps) or 'No modifiers', parent=self.root)
 
     def setup_dialog(self, dialog, setter):
-        dialog.on_change += [setter, self.update_preview]
-        dialog.on_cancel += [self.batch.cancel_modifier, self.update_preview]
+        dialog.on_change += [setter, self.on_modifiers_change]
+        dialog.on_cancel += [self.batch.cancel_modifier, self.on_modifiers_change]
         dialog.on_confirm += [self.batch.confirm_modifier]
 
     def image_resize(self):
-        width, height = self.image.width(), self.image.height()
+        width, height = self.batch.get_output_size(self.preview_filename)
         dialog = ResizeImageDialog(self.root, width, height, maintain_aspect_ratio=self.batch.maintain_aspect_ratio, primary_dimension=self.batch.primary_dimension)
         self.setup_dialog(dialog, self.batch.set_image_size)
 
     def image_crop(self):
-        width, height = self.image.width(), self.image.height()
+        width, height = self.batch.get_output_size(self.preview_filename)
         dialog = CropImageDialog(self.root, width, height, maintain_aspect_ratio=self.batch.maintain_aspect_ratio, primary_dimension=self.batch.primary_dimension, anchor=self.batch.anchor)
         self.setup_dialog(dialog, self.batch.set_image_crop)
 
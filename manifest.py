@@ -0,0 +1,142 @@
+"""Records which inputs have been processed into a save destination, so re-running a batch only processes new or
+changed files and an interrupted batch resumes where it stopped.
+
+The manifest is a JSON lines file in the save destination. Each processed file appends a line with the input's path,
+size, modification time and content hash, the hash of the recipe (modifiers and options that change the output) and
+the output's path, size and modification time. Appending (rather than rewriting) means a crash loses at most the line
+being written; the last line for an input wins and compact() rewrites the file with one line per input."""
+
+from os import path
+import hashlib
+import json
+import os
+import recipe
+
+MANIFEST_NAME = '.pillowgui-manifest.jsonl'
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def recipe_digest(modifiers, **options):
+    data = recipe.to_dict(modifiers)
+    data['options'] = options
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def move_aside(filenames, outfiles, owners=None):
+    """Returns outfiles with every output that belongs to another input moved aside (img.jpg becomes img-1.jpg,
+    img-2.jpg, ...). An output belongs to another input if owners (absolute output path -> absolute input path) says
+    so or an earlier file of filenames got it. An input that was moved aside before gets the same output again, as
+    its recorded output is its own."""
+
+    owners = owners or {}
+    claimed = {} # Absolute output path -> absolute input path, of the outputs given out so far
+    result = []
+
+    for filename, outfile in zip(filenames, outfiles):
+        input_ = path.abspath(filename)
+        stem, ext = path.splitext(outfile)
+        candidate, number = outfile, 0
+
+        while owners.get(path.abspath(candidate), input_) != input_ or claimed.get(path.abspath(candidate), input_) != input_:
+            number += 1
+            candidate = f'{stem}-{number}{ext}'
+
+        claimed[path.abspath(candidate)] = input_
+        result.append(candidate)
+
+    return result
+
+class Manifest:
+    def __init__(self, save_dest, recipe_digest):
+        self.filename = path.join(save_dest, MANIFEST_NAME)
+        self.recipe_digest = recipe_digest
+        self.entries = {} # Absolute input path -> most recent entry
+        self.owners = {} # Absolute output path -> absolute input path it was recorded for
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The line that was being written when the last run was interrupted
+                        continue
+                    self.add(entry)
+        except FileNotFoundError:
+            pass
+
+    def is_current(self, filename, outfile):
+        """Returns whether filename was processed into outfile with the same recipe, hasn't changed since and its
+        output is still the one it was processed into (by its size and modification time). Files whose size and
+        modification time match aren't read again."""
+
+        entry = self.entries.get(path.abspath(filename))
+        if entry is None or entry['recipe'] != self.recipe_digest or entry['output'] != path.abspath(outfile):
+            return False
+
+        try:
+            output_stat = os.stat(outfile)
+        except OSError:
+            return False
+
+        # Outputs replaced since, e.g. by another program, are written again
+        if (output_stat.st_size, output_stat.st_mtime_ns) != (entry.get('output_size'), entry.get('output_mtime')):
+            return False
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+
+        if (stat.st_size, stat.st_mtime_ns) == (entry['size'], entry['mtime']):
+            return True
+
+        # Touched or copied but possibly unchanged
+        if file_digest(filename) == entry['digest']:
+            self.record(filename, entry['digest'], entry['output'])
+            return True
+
+        return False
+
+    def add(self, entry):
+        previous = self.entries.get(entry['input'])
+        if previous is not None and self.owners.get(previous['output']) == entry['input']:
+            del self.owners[previous['output']]
+        self.entries[entry['input']] = entry
+        self.owners[entry['output']] = entry['input']
+
+    def claim_outfiles(self, filenames, outfiles):
+        """Returns outfiles with every output that an earlier run recorded for another input moved aside, see
+        move_aside, so that runs of different folders into one save destination never overwrite each other's outputs."""
+        return move_aside(filenames, outfiles, self.owners)
+
+    def record(self, filename, digest, outfile):
+        stat = os.stat(filename)
+        output_stat = os.stat(outfile)
+        entry = {
+            'input': path.abspath(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'digest': digest,
+            'recipe': self.recipe_digest,
+            'output': path.abspath(outfile),
+            'output_size': output_stat.st_size,
+            'output_mtime': output_stat.st_mtime_ns,
+        }
+        self.add(entry)
+
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def compact(self):
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(temp_filename, self.filename)
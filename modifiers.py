@@ -1,4 +1,21 @@
 from PIL import ImageEnhance
+import copy
+import functools
+import struct
+
+def float32(value):
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+def blend_value(degenerate, value, factor):
+    """Mirrors Image.blend for a single 8-bit value, which works in single precision and truncates."""
+    result = float32(degenerate + float32(factor * (value - degenerate)))
+    return min(max(int(result), 0), 255)
+
+@functools.lru_cache(maxsize=1024)
+def blend_table(degenerate, factor):
+    """Returns blend_value for every 8-bit value. Building the table is most of the Python work a PointModifier does
+    per image, and a batch only ever needs a few of them (degenerate is 0 or a mean from 0 to 255) so they're kept."""
+    return tuple(blend_value(degenerate, value, factor) for value in range(256))
 
 class ImageModifier:
 
@@ -7,6 +24,13 @@ class ImageModifier:
     def apply(self, image):
         pass
 
+    def output_size(self, size):
+        return size
+
+    def scaled(self, factor):
+        """Returns a modifier that does the same thing to a copy of the image scaled by factor."""
+        return self
+
     def __repr__(self):
         return self.__class__.__name__
 
@@ -42,37 +66,157 @@ class SharpnessModifier(ImageModifier):
     def apply(self, image):
         return ImageEnhance.Sharpness(image).enhance(self.value)
 
-class ResizeModifier(ImageModifier):
-    def __init__(self, width, height, maintain_aspect_ratio, primary_dimension='width'):
+class PointModifier(ImageModifier):
 
-        if type(width) != type(height):
-            raise TypeError('width and height must be the same type (float or int)')
+    """Applies a run of color, contrast and brightness modifiers as a per-channel lookup table, a color matrix and a
+    second lookup table, instead of building a degenerate image and blending the whole image once per modifier.
 
-        self.width = width
-        self.height = height
-        self.maintain_aspect_ratio = maintain_aspect_ratio
-        self.primary_dimension = primary_dimension
+    The contrast/brightness modifiers before the color modifier go in the first table and the brightness modifiers
+    after it go in the second. Without a color modifier the output is identical to applying the modifiers one by one,
+    except that an RGB contrast mean is taken from the channel histograms rather than a greyscale copy and can be off
+    by one. The color matrix uses the exact rather than the rounded luminance, which is within 2 levels per channel of
+    ImageEnhance; values above 1 of any modifier after it in the chain (this one's brightness modifiers included)
+    scale that difference up. Modes other than L, LA, RGB and RGBA fall back to the separate modifiers."""
 
-    def apply(self, image):
-        im_width, im_height = image.width, image.height
-        width, height = self.width, self.height
+    MODES = ('L', 'LA', 'RGB', 'RGBA')
 
-        if isinstance(self.width, float) and isinstance(self.height, float):
-            width = round(width * im_width)
-            height = round(height * im_height)
+    # Weights Pillow uses to convert RGB to L
+    LUMA = (19595 / 65536, 38470 / 65536, 7471 / 65536)
 
-        elif self.maintain_aspect_ratio:
-            if self.primary_dimension == 'width':
-                ratio = im_height / im_width
-                height = round(width * ratio)
+    def __init__(self, modifiers):
+        self.modifiers = list(modifiers)
+        self.histogram = None # Histogram contrast means are taken from instead of the image's, see with_histogram
+        self.pre = [] # Contrast/brightness modifiers before the first color modifier
+        self.color = None # Value of the color modifier
+        self.post = [] # Brightness modifiers after the color modifier
+
+        for modifier in self.modifiers:
+            if isinstance(modifier, ColorModifier):
+                self.color = modifier.value
+            elif self.color is None:
+                self.pre.append(modifier)
             else:
-                ratio = im_width / im_height
-                width = round(height * ratio)
+                self.post.append(modifier)
 
-        return image.resize((width, height))
+    def __repr__(self):
+        return f'{self.__class__.__name__}({", ".join(map(repr, self.modifiers))})'
 
-class CropModifier(ImageModifier):
-    def __init__(self, width, height, maintain_aspect_ratio, primary_dimension='width', anchor='Top'):
+    def needs_histogram(self):
+        return any(isinstance(modifier, ContrastModifier) for modifier in self.pre + self.post)
+
+    def with_histogram(self, histogram):
+        """Returns a copy that takes contrast means from histogram rather than the image it's applied to, so that the
+        tiles of an image get the same tables as the whole image."""
+
+        modifier = copy.copy(self)
+        modifier.histogram = histogram
+        return modifier
+
+    def can_fuse(self, modifier):
+        """Returns whether modifier can be appended. Only one color modifier is allowed since the rounding of each
+        color matrix would otherwise add up, and no contrast modifier after it since its mean would have to be taken
+        from the image after the color matrix rather than from the histogram of the input."""
+
+        if isinstance(modifier, (ColorModifier, ContrastModifier)):
+            return self.color is None
+        return True
+
+    def apply(self, image):
+        if image.mode not in self.MODES:
+            for modifier in self.modifiers:
+                image = modifier.apply(image)
+            return image
+
+        pre_luts, post_luts = self.get_luts(image)
+
+        if self.pre:
+            image = image.point(self.flatten(pre_luts, image))
+
+        if self.color is not None and self.color != 1 and image.mode in ('RGB', 'RGBA'):
+            image = self.apply_color(image)
+
+        if self.post:
+            image = image.point(self.flatten(post_luts, image))
+
+        return image
+
+    def get_luts(self, image):
+        channels = len(image.mode.replace('A', ''))
+        pre = [list(range(256)) for _ in range(channels)]
+        post = [list(range(256)) for _ in range(channels)]
+        histogram = self.histogram
+
+        for luts, modifiers in ((pre, self.pre), (post, self.post)):
+            for modifier in modifiers:
+                if isinstance(modifier, ContrastModifier):
+                    if histogram is None:
+                        histogram = image.histogram()
+                    degenerate = int(self.get_mean(histogram, pre, post) + 0.5)
+                else:
+                    degenerate = 0
+
+                table = blend_table(degenerate, float32(modifier.value))
+                for lut in luts:
+                    lut[:] = [table[value] for value in lut]
+
+        return pre, post
+
+    def get_mean(self, histogram, pre, post):
+        weights = self.LUMA if len(pre) == 3 else (1.0,)
+        mean = 0.0
+
+        for channel, weight in enumerate(weights):
+            counts = histogram[channel * 256:(channel + 1) * 256]
+            total = sum(counts) or 1
+            mean += weight * sum(count * post[channel][pre[channel][value]] for value, count in enumerate(counts)) / total
+
+        return mean
+
+    def flatten(self, luts, image):
+        table = [value for lut in luts for value in lut]
+        if 'A' in image.mode:
+            table += list(range(256))
+        return table
+
+    def apply_color(self, image):
+        value = self.color
+        matrix = []
+        for channel in range(3):
+            row = [(1 - value) * weight for weight in self.LUMA]
+            row[channel] += value
+            matrix += row + [-0.5] # Offset so that the matrix conversion truncates like Image.blend
+
+        if image.mode == 'RGBA':
+            alpha = image.getchannel('A')
+            image = image.convert('RGB').convert('RGB', matrix)
+            image.putalpha(alpha)
+            return image
+
+        return image.convert('RGB', matrix)
+
+POINT_MODIFIERS = (ColorModifier, ContrastModifier, BrightnessModifier)
+
+def fuse_point_modifiers(modifiers):
+    """Replaces every run of color, contrast and brightness modifiers with PointModifiers."""
+
+    fused = []
+    for modifier in modifiers:
+        if isinstance(modifier, POINT_MODIFIERS):
+            if fused and isinstance(fused[-1], PointModifier) and fused[-1].can_fuse(modifier):
+                fused[-1] = PointModifier(fused[-1].modifiers + [modifier])
+            else:
+                fused.append(PointModifier([modifier]))
+        else:
+            fused.append(modifier)
+
+    return fused
+
+class GeometryModifier(ImageModifier):
+
+    """Base class for modifiers that change the size of an image. Integer dimensions are absolute pixel values
+    and float dimensions are fractions of the image size."""
+
+    def __init__(self, width, height, maintain_aspect_ratio, primary_dimension='width'):
 
         if type(width) != type(height):
             raise TypeError('width and height must be the same type (float or int)')
@@ -81,10 +225,9 @@ class CropModifier(ImageModifier):
         self.height = height
         self.maintain_aspect_ratio = maintain_aspect_ratio
         self.primary_dimension = primary_dimension
-        self.anchor = anchor
 
-    def apply(self, image):
-        im_width, im_height = image.width, image.height
+    def get_size(self, size):
+        im_width, im_height = size
         width, height = self.width, self.height
 
         if isinstance(self.width, float) and isinstance(self.height, float):
@@ -99,6 +242,32 @@ class CropModifier(ImageModifier):
                 ratio = im_width / im_height
                 width = round(height * ratio)
 
+        return width, height
+
+    def scaled(self, factor):
+        if isinstance(self.width, float):
+            return self
+
+        modifier = copy.copy(self)
+        modifier.width = max(1, round(self.width * factor))
+        modifier.height = max(1, round(self.height * factor))
+        return modifier
+
+class ResizeModifier(GeometryModifier):
+    def apply(self, image):
+        return image.resize(self.get_size(image.size))
+
+    def output_size(self, size):
+        return self.get_size(size)
+
+class CropModifier(GeometryModifier):
+    def __init__(self, width, height, maintain_aspect_ratio, primary_dimension='width', anchor='Top'):
+        super().__init__(width, height, maintain_aspect_ratio, primary_dimension=primary_dimension)
+        self.anchor = anchor
+
+    def get_box(self, size):
+        im_width, im_height = size
+        width, height = self.get_size(size)
 
         x_crop = im_width - width
         y_crop = im_height - height
@@ -155,4 +324,11 @@ class CropModifier(ImageModifier):
             right_x = im_width
             right_y = im_height
 
-        return image.crop((left_x, left_y, right_x, right_y))
+        return left_x, left_y, right_x, right_y
+
+    def apply(self, image):
+        return image.crop(self.get_box(image.size))
+
+    def output_size(self, size):
+        left_x, left_y, right_x, right_y = self.get_box(size)
+        return round(right_x) - round(left_x), round(right_y) - round(left_y)
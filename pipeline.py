@@ -0,0 +1,390 @@
+"""Runs a modifier chain over files, either as a pipeline of threads or on a pool of worker processes."""
+
+from PIL import Image
+from collections import namedtuple, deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
+from os import path
+import io
+import itertools
+import math
+import multiprocessing
+import os
+import queue
+import threading
+from profiling import image_bytes, pixel_bytes, timed
+import manifest
+import planner
+import tiling
+
+# What process_file did with one file. digest is the hash of the input file's content and stages the list of
+# profiling.Stage it took, if they were asked for.
+FileResult = namedtuple('FileResult', ('filename', 'outfile', 'digest', 'stages'), defaults=(None,))
+
+# Like Image.thumbnail, reduced decodes keep at least twice the resolution the leading downscale needs so the
+# resize that follows still has detail to work with
+REDUCING_GAP = 2.0
+
+# Default number of threads stream_files encodes and writes outputs on
+IO_WORKERS = 2
+
+# Default number of bytes of decoded and processed images the streaming pipeline may hold at once
+MEMORY_BUDGET = 1 << 30
+
+def apply_modifiers(image, modifiers, size=None, stages=None, filename='', tile_size=None):
+    """Applies modifiers planned for an image of the given size (by default the size of image). Only a leading
+    resize/crop copes with image being smaller than size, see open_image. If stages is a list, a profiling.Stage is
+    appended to it for every step.
+
+    If tile_size is given, images with more than tiling.MIN_PIXELS pixels whose plan can be tiled are processed in
+    tiles of that size (see tiling.py), in one stage."""
+
+    steps = planner.plan(modifiers, size or image.size)
+
+    if tile_size and image.width * image.height > tiling.MIN_PIXELS and image.size == (size or image.size) and tiling.can_tile(steps, image):
+        return timed(stages, filename, 'tiled', tiling.apply_tiled, image, steps, tile_size, detail=planner.describe(steps))
+
+    for step in steps:
+        image = timed(stages, filename, type(step).__name__, step.apply, image, detail=repr(step))
+
+    return image
+
+def get_output_size(modifiers, size):
+    for modifier in modifiers:
+        size = modifier.output_size(size)
+
+    return size
+
+def get_decode_size(modifiers, size):
+    """Returns the smallest size an image of the given size can be decoded at when modifiers start with a downscale,
+    or None if they don't."""
+
+    steps = planner.plan(modifiers, size)
+    if not steps or not isinstance(steps[0], planner.ResampleStep):
+        return None
+
+    step = steps[0]
+    left_x, left_y, right_x, right_y = step.box
+    width = math.ceil(size[0] * REDUCING_GAP * step.size[0] / (right_x - left_x))
+    height = math.ceil(size[1] * REDUCING_GAP * step.size[1] / (right_y - left_y))
+
+    if width >= size[0] or height >= size[1]:
+        return None
+
+    return width, height
+
+def reduce_decode(image, decode_size):
+    """Asks the decoder of an image that hasn't been loaded yet to decode it at (at least) decode_size. Only JPEG and
+    JPEG 2000 can do this, other formats are left alone."""
+
+    if image.format == 'JPEG2000':
+        # JPEG 2000 decodes at 1 / 2 ** reduce of the full resolution
+        factor = min(image.width // decode_size[0], image.height // decode_size[1])
+        if factor >= 2:
+            image.reduce = int(math.log2(factor))
+    else:
+        image.draft(image.mode, decode_size)
+
+def open_image(filename, modifiers, draft=True):
+    """Opens filename for modifiers, decoding it at a reduced size if they start with a downscale. Returns the image
+    and the size the modifiers have to be planned for, which is the size of the file."""
+
+    image = Image.open(filename)
+    size = image.size
+
+    if draft:
+        decode_size = get_decode_size(modifiers, size)
+        if decode_size:
+            reduce_decode(image, decode_size)
+
+    return image, size
+
+def get_outfiles(filenames, save_dest, owners=None):
+    """Returns the output path of each file, which goes straight into save_dest whatever else is in the run, so adding
+    files never moves the outputs of others. Outputs of files with the same name, or that owners (see
+    manifest.move_aside) gives to other inputs, are moved aside."""
+
+    return manifest.move_aside(filenames, [f'{save_dest}/{path.split(filename)[1]}' for filename in filenames], owners)
+
+def load_image(image, decode_cache=None):
+    """Loads image and closes its file, which load alone doesn't do for formats with several frames. If decode_cache
+    (a decodecache.DecodeCache) is given, images of slow formats are mapped from it rather than decoded when they can."""
+
+    if decode_cache is not None:
+        return decode_cache.load(image)
+
+    with image:
+        image.load()
+    return image
+
+def get_format(outfile):
+    format = Image.registered_extensions().get(path.splitext(outfile)[1].lower())
+    if format is None:
+        raise ValueError(f'unknown file extension: {outfile}')
+    return format
+
+def encode_image(image, format, options):
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    return buffer.getvalue()
+
+def write_file(data, outfile):
+    """Writes data to outfile through a temporary file, so outfile is never left half written."""
+
+    temp_filename = f'{outfile}.{os.getpid()}.{threading.get_ident()}.tmp'
+    os.makedirs(path.dirname(outfile) or '.', exist_ok=True)
+    try:
+        with open(temp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(temp_filename, outfile)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
+    return outfile
+
+def save_image(image, outfile, encoder_options=None, stages=None, filename=''):
+    """Saves image in the format of outfile's extension. encoder_options maps format names (as in Image.SAVE, e.g.
+    'JPEG') to the keyword arguments the encoder gets, e.g. {'JPEG': {'quality': 90, 'progressive': True}}. Encoding
+    and writing are separate stages."""
+
+    format = get_format(outfile)
+    options = (encoder_options or {}).get(format, {})
+    data = timed(stages, filename, 'encode', encode_image, image, format, options, detail=format, measure=len)
+    timed(stages, filename, 'write', write_file, data, outfile, measure=lambda _: len(data))
+    return outfile
+
+def process_file(filename, modifiers, outfile, draft=True, digest=False, profile=False, tile_size=None, encoder_options=None, decode_cache=None):
+    stages = [] if profile else None
+    input_digest = timed(stages, filename, 'hash', manifest.file_digest, filename, measure=lambda _: path.getsize(filename)) if digest else None
+
+    image, size = timed(stages, filename, 'open', open_image, filename, modifiers, draft, measure=lambda _: 0)
+    image = timed(stages, filename, 'decode', load_image, image, decode_cache)
+    processed_im = apply_modifiers(image, modifiers, size, stages, filename, tile_size)
+
+    save_image(processed_im, outfile, encoder_options, stages, filename)
+    return FileResult(filename, outfile, input_digest, stages)
+
+def estimate_bytes(image, modifiers, size):
+    """Estimates the memory a file holds while it goes through the pipeline, the decoded image (image is opened but
+    not loaded, and possibly set to decode at a reduced size) plus the output."""
+
+    return image_bytes(image) + pixel_bytes(image.mode, get_output_size(modifiers, size))
+
+class MemoryBudget:
+
+    """Keeps track of the bytes of images in the pipeline. acquire blocks while the images would go over max_bytes,
+    except when nothing else is held, so that an image larger than the budget still gets processed (on its own)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes, stop):
+        """Returns False without acquiring if stop (a threading.Event) is set while waiting."""
+
+        with self.condition:
+            while self.used and self.used + nbytes > self.max_bytes:
+                if stop.is_set():
+                    return False
+                self.condition.wait(0.1)
+            self.used += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+# Put on a stage's queue after its last item
+_DONE = object()
+
+def _get(inbox, stop, on_idle=None):
+    while not stop.is_set():
+        try:
+            return inbox.get(timeout=0.1)
+        except queue.Empty:
+            if on_idle:
+                on_idle()
+    return _DONE
+
+def _put(outbox, item, stop):
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _drain(inbox, stop, on_idle=None):
+    """Yields the items put on inbox until _DONE, calling on_idle every so often while waiting for one."""
+
+    while True:
+        item = _get(inbox, stop, on_idle)
+        if item is _DONE:
+            return
+        yield item
+
+def _run_stage(items, function, outbox, stop, errors):
+    """Puts function(item) on outbox for every item until items runs out or stop is set. function returns None to
+    skip an item. The first exception stops every stage and is re-raised by stream_files."""
+
+    try:
+        for item in items:
+            if stop.is_set():
+                return
+            result = function(item)
+            if result is not None:
+                _put(outbox, result, stop)
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        _put(outbox, _DONE, stop)
+
+def stream_files(filenames, modifiers, outfiles, draft=True, digest=False, profile=False, tile_size=None, encoder_options=None, decode_cache=None,
+                 memory_budget=MEMORY_BUDGET, queue_size=2, io_workers=IO_WORKERS, on_result=None, cancelled=None):
+    """Like process_files on the calling thread, but decoding and applying the modifiers run on their own threads
+    (Pillow releases the GIL while it works) connected by queues of at most queue_size images, and outputs are encoded
+    and written on a pool of io_workers threads. Decoding waits while the images in the pipeline would take more than
+    memory_budget bytes, so a slow encoder or disk holds back decoding rather than letting decoded images pile up.
+
+    Once cancelled is set, files that haven't started saving are dropped and the saves under way are finished."""
+
+    cancelled = cancelled or threading.Event()
+
+    budget = MemoryBudget(memory_budget)
+    stop = threading.Event()
+    errors = []
+    decoded = queue.Queue(maxsize=queue_size)
+    processed = queue.Queue(maxsize=queue_size)
+
+    def decode(item):
+        filename, outfile = item
+        stages = [] if profile else None
+        input_digest = timed(stages, filename, 'hash', manifest.file_digest, filename, measure=lambda _: path.getsize(filename)) if digest else None
+        image, size = timed(stages, filename, 'open', open_image, filename, modifiers, draft, measure=lambda _: 0)
+
+        nbytes = estimate_bytes(image, modifiers, size)
+        if not budget.acquire(nbytes, stop):
+            image.close()
+            return None
+
+        image = timed(stages, filename, 'decode', load_image, image, decode_cache)
+        return filename, outfile, input_digest, image, size, nbytes, stages
+
+    def process(item):
+        filename, outfile, input_digest, image, size, nbytes, stages = item
+        if cancelled.is_set():
+            budget.release(nbytes)
+            return None
+        return filename, outfile, input_digest, apply_modifiers(image, modifiers, size, stages, filename, tile_size), nbytes, stages
+
+    threads = [
+        threading.Thread(target=_run_stage, args=(itertools.takewhile(lambda _: not cancelled.is_set(), zip(filenames, outfiles)), decode, decoded, stop, errors),
+                         name='decode', daemon=True),
+        threading.Thread(target=_run_stage, args=(_drain(decoded, stop), process, processed, stop, errors), name='process', daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    results = []
+    saving = deque() # (FileResult, future of the save) in the order of filenames
+
+    def finish_save():
+        result, future = saving.popleft()
+        future.result()
+
+        results.append(result)
+        if on_result:
+            on_result(result)
+
+    def finish_saved():
+        # Results are passed on in order as soon as the saves before them have finished
+        while saving and saving[0][1].done():
+            finish_save()
+
+    try:
+        with ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='save') as executor:
+            for filename, outfile, input_digest, image, nbytes, stages in _drain(processed, stop, on_idle=finish_saved):
+                if cancelled.is_set():
+                    budget.release(nbytes)
+                    continue
+
+                future = executor.submit(save_image, image, outfile, encoder_options, stages, filename)
+                future.add_done_callback(lambda future, nbytes=nbytes: budget.release(nbytes))
+                saving.append((FileResult(filename, outfile, input_digest, stages), future))
+                del image
+
+                finish_saved()
+                while len(saving) > io_workers:
+                    finish_save()
+
+            while saving:
+                finish_save()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+# Each worker process receives the modifier chain once (through the pool initializer) rather than with every file
+_worker_modifiers = None
+_worker_options = {}
+
+def _init_worker(modifiers, options):
+    global _worker_modifiers, _worker_options
+    _worker_modifiers = modifiers
+    _worker_options = options
+
+def _process_in_worker(filename, outfile):
+    return process_file(filename, _worker_modifiers, outfile, **_worker_options)
+
+def process_files(filenames, modifiers, save_dest, workers=1, draft=True, digest=False, profile=False, tile_size=None, encoder_options=None,
+                  decode_cache=None, memory_budget=MEMORY_BUDGET, io_workers=IO_WORKERS, outfiles=None, on_result=None, cancelled=None):
+    """Processes every file and returns a FileResult for each in the same order as filenames. on_result is called
+    (on the calling thread) with each FileResult as soon as it's available. outfiles are the output paths, by default
+    get_outfiles(filenames, save_dest).
+
+    Setting cancelled (a threading.Event) stops processing between files and returns the results of the files that
+    were finished. Outputs are replaced in one step (see write_file), so none is left half written.
+
+    With one worker the files go through stream_files, otherwise each worker process runs process_file on one file at
+    a time. Both apply the same functions so the parallel output is identical to the serial output."""
+
+    options = dict(draft=draft, digest=digest, profile=profile, tile_size=tile_size, encoder_options=encoder_options, decode_cache=decode_cache)
+    outfiles = outfiles or get_outfiles(filenames, save_dest)
+    results = []
+
+    if workers <= 1 or len(filenames) <= 1:
+        return stream_files(filenames, modifiers, outfiles, memory_budget=memory_budget, io_workers=io_workers, on_result=on_result,
+                            cancelled=cancelled, **options)
+
+    workers = min(workers, len(filenames))
+
+    # Large chunks keep the per-file IPC overhead low, several chunks per worker keep the load balanced. Worker
+    # processes can't see cancellation, so when the run can be cancelled the files are sent one at a time and only the
+    # few files sent ahead to the workers are still processed once it's cancelled.
+    chunksize = 1 if cancelled is not None else max(1, len(filenames) // (workers * 4))
+
+    # 'spawn' avoids forking the Tk interpreter into the workers
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(list(modifiers), options)) as executor:
+        try:
+            for result in executor.map(_process_in_worker, filenames, outfiles, chunksize=chunksize):
+                results.append(result)
+                if on_result:
+                    on_result(result)
+                if cancelled is not None and cancelled.is_set():
+                    # Drops the files that haven't been sent to a worker, the results of the others still come in
+                    executor.shutdown(wait=False, cancel_futures=True)
+        except CancelledError:
+            # Reached the first dropped file
+            pass
+
+    return results
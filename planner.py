@@ -0,0 +1,155 @@
+"""Turns a modifier chain into the steps that are actually run on an image of a given size.
+
+The plan differs from the chain in three ways:
+    * Color/brightness modifiers are moved after crops that reduce the number of pixels, so they run on fewer pixels.
+      They work pixel by pixel, so this is exact. They aren't moved past resizes, since rounding and clipping to 0-255
+      don't commute with resampling, and contrast isn't moved at all since its mean depends on the whole image.
+    * Consecutive resizes and crops are merged into one ResampleStep, a single Image.resize of a box of the source.
+      Single resizes and crops become ResampleSteps as well, so that they work on images decoded at a reduced size.
+      A merged resample keeps the geometry but isn't byte-identical to resampling several times, and a run stops at
+      an upscale that follows a downscale, since merging those would bring back the detail the downscale dropped.
+    * Runs of color/contrast/brightness modifiers are fused into PointModifiers.
+Anything else (e.g. sharpness) stays where it is and nothing is moved across it."""
+
+from modifiers import ImageModifier, GeometryModifier, CropModifier, ResizeModifier, ContrastModifier, POINT_MODIFIERS, fuse_point_modifiers
+
+class ResampleStep(ImageModifier):
+
+    """Resizes box (in the coordinates of an image of source_size) to size."""
+
+    def __init__(self, source_size, box, size):
+        self.source_size = source_size
+        self.box = box
+        self.size = size
+
+    def __repr__(self):
+        box = ', '.join(f'{value:g}' for value in self.box)
+        return f'{self.__class__.__name__}({self.source_size[0]}x{self.source_size[1]} [{box}] -> {self.size[0]}x{self.size[1]})'
+
+    def apply(self, image):
+        box = self.box
+
+        # The image is smaller than planned for when it was decoded at a reduced size
+        if image.size != self.source_size:
+            x_scale = image.width / self.source_size[0]
+            y_scale = image.height / self.source_size[1]
+            box = (box[0] * x_scale, box[1] * y_scale, box[2] * x_scale, box[3] * y_scale)
+
+        left_x, left_y, right_x, right_y = box
+
+        if self.size == (right_x - left_x, right_y - left_y) and all(float(value).is_integer() for value in box):
+            if box == (0, 0) + image.size:
+                return image
+            return image.crop(box)
+
+        return image.resize(self.size, box=box)
+
+    def output_size(self, size):
+        return self.size
+
+def merge_geometry(modifiers, size):
+    """Returns a ResampleStep doing the same as the run of geometry modifiers, or None if they can't be merged."""
+
+    left_x, left_y = 0, 0
+    box_width, box_height = size
+    current = size
+
+    for modifier in modifiers:
+        if isinstance(modifier, CropModifier):
+            # Image.crop rounds the box and pads anything outside the image, which a resize can't do
+            crop_box = tuple(round(value) for value in modifier.get_box(current))
+            if crop_box[0] < 0 or crop_box[1] < 0 or crop_box[2] > current[0] or crop_box[3] > current[1]:
+                return None
+
+            x_scale, y_scale = box_width / current[0], box_height / current[1]
+            left_x += crop_box[0] * x_scale
+            left_y += crop_box[1] * y_scale
+            box_width = (crop_box[2] - crop_box[0]) * x_scale
+            box_height = (crop_box[3] - crop_box[1]) * y_scale
+
+        current = modifier.output_size(current)
+
+        if current[0] <= 0 or current[1] <= 0:
+            return None
+
+    return ResampleStep(size, (left_x, left_y, left_x + box_width, left_y + box_height), current)
+
+# Changes whenever the plan of a chain changes its output, so that manifests don't consider older outputs current
+PLAN_VERSION = 3
+
+def get_scaling(modifier, size):
+    """Returns whether a resize of an image of the given size shrinks it in some dimension and whether it enlarges it
+    in some dimension. Crops do neither."""
+
+    if not isinstance(modifier, ResizeModifier):
+        return False, False
+
+    width, height = modifier.output_size(size)
+    return width < size[0] or height < size[1], width > size[0] or height > size[1]
+
+def can_move_after(point_modifier, geometry_modifier, size):
+    """Returns whether a color/contrast/brightness modifier can run after geometry_modifier instead of before it
+    without changing the output."""
+
+    if isinstance(point_modifier, ContrastModifier) or not isinstance(geometry_modifier, CropModifier):
+        return False
+
+    width, height = geometry_modifier.output_size(size)
+    return width * height < size[0] * size[1]
+
+def reorder(modifiers, size):
+    modifiers = list(modifiers)
+    moved = True
+
+    # Bubble point modifiers towards the end for as long as the next modifier is a crop they commute with
+    while moved:
+        moved = False
+        current = size
+
+        for index in range(len(modifiers) - 1):
+            modifier, next_modifier = modifiers[index], modifiers[index + 1]
+
+            if isinstance(modifier, POINT_MODIFIERS) and isinstance(next_modifier, GeometryModifier) and can_move_after(modifier, next_modifier, current):
+                modifiers[index], modifiers[index + 1] = next_modifier, modifier
+                moved = True
+
+            current = modifiers[index].output_size(current)
+
+    return modifiers
+
+def plan(modifiers, size):
+    """Returns the steps to apply to an image of the given size in place of modifiers."""
+
+    steps = []
+    run = [] # Consecutive geometry modifiers
+    run_size = current = size
+    downscaled = False # Whether a modifier of the run shrinks the image
+
+    def end_run():
+        if run:
+            step = merge_geometry(run, run_size)
+            steps.extend([step] if step else run)
+            run.clear()
+
+    for modifier in reorder(modifiers, size) + [None]:
+        if isinstance(modifier, GeometryModifier):
+            shrinks, enlarges = get_scaling(modifier, current)
+            if downscaled and enlarges:
+                end_run()
+            if not run:
+                run_size = current
+                downscaled = False
+            run.append(modifier)
+            downscaled = downscaled or shrinks
+        else:
+            end_run()
+            if modifier is not None:
+                steps.append(modifier)
+
+        if modifier is not None:
+            current = modifier.output_size(current)
+
+    return fuse_point_modifiers(steps)
+
+def describe(steps):
+    return '\n'.join(f'{index + 1}. {step!r}' for index, step in enumerate(steps))
@@ -0,0 +1,146 @@
+"""Per-stage instrumentation of the processing pipeline.
+
+The pipeline functions take an optional list which they append a Stage to for decoding, every step of the plan and
+saving. Stages are plain tuples so they can be sent back from worker processes, and Profiler collects them into
+per-stage totals and a trace file in the Chrome trace event format (open it in chrome://tracing or Perfetto)."""
+
+from collections import namedtuple, OrderedDict
+import json
+import os
+import threading
+import time
+
+# start is wall clock time (time.time) so that stages from different processes line up. nbytes is the size of the
+# pixel buffer the stage produced (or the size of the file it wrote).
+Stage = namedtuple('Stage', ('filename', 'name', 'detail', 'start', 'wall', 'cpu', 'nbytes', 'pid', 'thread'))
+
+# Bytes per pixel of Pillow's internal storage for each mode
+PIXEL_SIZES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I': 4, 'F': 4}
+
+def pixel_bytes(mode, size):
+    return size[0] * size[1] * PIXEL_SIZES.get(mode, 4)
+
+def image_bytes(image):
+    size = getattr(image, 'size', None)
+    if size is None:
+        return 0
+    return pixel_bytes(image.mode, size)
+
+def timed(stages, filename, name, function, *args, detail='', measure=image_bytes):
+    """Calls function with args, appending a Stage to stages (unless it's None) for the call. measure is called with
+    the result to get the stage's nbytes."""
+
+    if stages is None:
+        return function(*args)
+
+    start, wall, cpu = time.time(), time.perf_counter(), time.thread_time()
+    result = function(*args)
+    wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+
+    stages.append(Stage(filename, name, detail, start, wall, cpu, measure(result), os.getpid(), threading.get_ident()))
+    return result
+
+class Profiler:
+
+    """Collects stages from previews and batch runs. Safe to share between threads."""
+
+    def __init__(self):
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def add(self, stages):
+        with self.lock:
+            self.stages.extend(stages)
+
+    def clear(self):
+        with self.lock:
+            self.stages = []
+
+    def get_totals(self):
+        """Returns an OrderedDict mapping stage names (in the order first seen) to count, wall, cpu and nbytes totals."""
+
+        totals = OrderedDict()
+        with self.lock:
+            stages = list(self.stages)
+
+        for stage in stages:
+            total = totals.setdefault(stage.name, dict(count=0, wall=0.0, cpu=0.0, nbytes=0))
+            total['count'] += 1
+            total['wall'] += stage.wall
+            total['cpu'] += stage.cpu
+            total['nbytes'] += stage.nbytes
+
+        return totals
+
+    def get_status(self):
+        """Returns a one line summary of the mean wall time of each stage."""
+
+        totals = self.get_totals()
+        with self.lock:
+            files = len({stage.filename for stage in self.stages})
+        parts = [f'{name} {total["wall"] / total["count"] * 1000:.1f}ms' for name, total in totals.items()]
+        return f'{files} files | ' + ' | '.join(parts) if parts else 'No stages recorded'
+
+    def get_summary(self):
+        lines = [f'{"Stage":<20}{"Count":>7}{"Wall (ms)":>12}{"Mean (ms)":>12}{"CPU (ms)":>12}{"MB":>10}']
+
+        for name, total in self.get_totals().items():
+            lines.append(f'{name:<20}{total["count"]:>7}{total["wall"] * 1000:>12.1f}{total["wall"] / total["count"] * 1000:>12.2f}'
+                         f'{total["cpu"] * 1000:>12.1f}{total["nbytes"] / (1 << 20):>10.1f}')
+
+        return '\n'.join(lines)
+
+    def write_trace(self, filename):
+        with self.lock:
+            stages = list(self.stages)
+
+        events = [dict(
+            name=stage.name,
+            cat='pipeline',
+            ph='X',
+            ts=stage.start * 1e6,
+            dur=stage.wall * 1e6,
+            pid=stage.pid,
+            tid=stage.thread,
+            args=dict(file=stage.filename, detail=stage.detail, cpu_ms=stage.cpu * 1000, bytes=stage.nbytes),
+        ) for stage in stages]
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+class Progress:
+
+    """Counts the files of a run as they finish, for a progress display. Safe to share between threads."""
+
+    def __init__(self):
+        self.total = 0
+        self.done = 0
+        self.nbytes = 0 # Bytes of input files done
+        self.started = None
+        self.lock = threading.Lock()
+
+    def start(self, total):
+        with self.lock:
+            self.total = total
+            self.started = time.monotonic()
+
+    def add(self, nbytes):
+        with self.lock:
+            self.done += 1
+            self.nbytes += nbytes
+
+    def get_rates(self):
+        """Returns files per second, megabytes per second and the seconds left (None until a file is done)."""
+
+        with self.lock:
+            if self.started is None:
+                return 0.0, 0.0, None
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            files_per_second = self.done / elapsed
+            eta = (self.total - self.done) / files_per_second if self.done else None
+            return files_per_second, self.nbytes / (1 << 20) / elapsed, eta
+
+    def get_status(self):
+        files_per_second, megabytes_per_second, eta = self.get_rates()
+        eta = f'{int(eta) // 60}:{int(eta) % 60:02}' if eta is not None else '-'
+        return f'{self.done}/{self.total} files | {files_per_second:.1f} images/s | {megabytes_per_second:.1f} MB/s | ETA {eta}'
@@ -0,0 +1,129 @@
+"""Saves and loads modifier chains ("recipes") as JSON or TOML.
+
+A recipe lists the modifiers in the order they are applied, each as a table of its constructor arguments plus the
+name of its class under 'type', e.g.
+
+    {"version": 1, "modifiers": [{"type": "ResizeModifier", "width": 0.5, "height": 0.5, ...}]}
+
+or in TOML
+
+    version = 1
+
+    [[modifiers]]
+    type = "ResizeModifier"
+    width = 0.5
+    ...
+
+Integer and float dimensions mean different things (pixels vs fractions) so numbers keep their type."""
+
+from os import path
+import inspect
+import json
+import modifiers
+
+try:
+    import tomllib
+except ImportError: # Python < 3.11
+    tomllib = None
+
+VERSION = 1
+
+MODIFIER_TYPES = {cls.__name__: cls for cls in (
+    modifiers.ColorModifier,
+    modifiers.ContrastModifier,
+    modifiers.BrightnessModifier,
+    modifiers.SharpnessModifier,
+    modifiers.ResizeModifier,
+    modifiers.CropModifier,
+)}
+
+def get_params(modifier):
+    params = inspect.signature(type(modifier).__init__).parameters
+    return {name: getattr(modifier, name) for name in params if name != 'self'}
+
+def to_dict(modifier_list):
+    return {
+        'version': VERSION,
+        'modifiers': [dict(type=type(modifier).__name__, **get_params(modifier)) for modifier in modifier_list],
+    }
+
+def from_dict(data):
+    if not isinstance(data, dict):
+        raise ValueError('a recipe must be a table with a list of modifiers')
+
+    version = data.get('version', VERSION)
+    if not isinstance(version, int):
+        raise ValueError(f'invalid recipe version {version!r}')
+    if version > VERSION:
+        raise ValueError(f'recipe version {version} is newer than this version of PillowGUI supports')
+
+    modifier_params = data.get('modifiers', [])
+    if not isinstance(modifier_params, list):
+        raise ValueError('the modifiers of a recipe must be a list')
+
+    modifier_list = []
+    for params in modifier_params:
+        if not isinstance(params, dict):
+            raise ValueError(f'invalid modifier {params!r}, modifiers must be tables')
+
+        params = dict(params)
+        name = params.pop('type', None)
+
+        if name not in MODIFIER_TYPES:
+            raise ValueError(f'unknown modifier type {name!r}')
+
+        try:
+            modifier_list.append(MODIFIER_TYPES[name](**params))
+        except TypeError as e:
+            raise ValueError(f'invalid {name}: {e}') from e
+
+    return modifier_list
+
+def dumps(modifier_list, format='json'):
+    data = to_dict(modifier_list)
+
+    if format == 'json':
+        return json.dumps(data, indent=4) + '\n'
+
+    lines = [f'version = {data["version"]}']
+    for params in data['modifiers']:
+        lines += ['', '[[modifiers]]']
+        lines += [f'{key} = {toml_value(value)}' for key, value in params.items()]
+
+    return '\n'.join(lines) + '\n'
+
+def loads(text, format='json'):
+    if format == 'json':
+        return from_dict(json.loads(text))
+
+    if tomllib is None:
+        raise ValueError('reading TOML recipes needs Python 3.11 or newer')
+
+    try:
+        return from_dict(tomllib.loads(text))
+    except tomllib.TOMLDecodeError as e:
+        raise ValueError(str(e)) from e
+
+def toml_value(value):
+    # Only the types modifiers take are needed
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return json.dumps(str(value))
+
+def get_format(filename):
+    return 'toml' if path.splitext(filename)[1].lower() == '.toml' else 'json'
+
+def save(filename, modifier_list):
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(dumps(modifier_list, get_format(filename)))
+
+def load(filename):
+    with open(filename, encoding='utf-8') as f:
+        text = f.read()
+
+    try:
+        return loads(text, get_format(filename))
+    except json.JSONDecodeError as e:
+        raise ValueError(str(e)) from e
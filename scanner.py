@@ -0,0 +1,61 @@
+"""Finds the supported images in a folder."""
+
+from os import path
+import os
+
+# https://pillow.readthedocs.io/en/5.1.x/handbook/image-file-formats.html#fully-supported-formats
+SUPPORTED_FILE_EXTENSIONS = (
+                             'bmp', 'dib', 
+                             'eps', 'epsf', 'epsi',
+                             'gif', 
+                             'icns', 
+                             'ico', 
+                             'im', 
+                             'jpg', 'jpeg', 'jpe', 'jif', 'jfif', 'jfi',
+                             'jp2', 'j2k', 'jpf', 'jpx', 'jpm', 'mj2',
+                             'msp',
+                             'pcx',
+                             'png',
+                             'pbm', 'pgm', 'ppm', 'pnm',
+                             'sgi',
+                             'tiff', 'tif',
+                             'webp',
+                             'xbm'
+                             )
+
+def scan_folder(folder, extensions=SUPPORTED_FILE_EXTENSIONS, cancelled=None):
+    """Yields the files below folder with one of the given extensions (in any case) as they are found.
+
+    The tree is walked once, directory by directory, with each directory's files yielded in name order before
+    its subdirectories are walked. Symlinked directories aren't followed so links can't make the walk loop.
+    Setting the cancelled event (a threading.Event) stops the walk at the next directory."""
+
+    extensions = {'.' + ext.lstrip('.').lower() for ext in extensions}
+    folders = [folder]
+
+    while folders:
+        if cancelled is not None and cancelled.is_set():
+            return
+
+        folder = folders.pop()
+        filenames = []
+        subfolders = []
+
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subfolders.append(entry.path)
+                        elif path.splitext(entry.name)[1].lower() in extensions:
+                            filenames.append(entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            # Unreadable folders are skipped, as glob does
+            continue
+
+        yield from sorted(filenames)
+
+        # Reversed so that the subfolders are popped (and so walked) in name order
+        folders.extend(sorted(subfolders, reverse=True))
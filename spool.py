@@ -0,0 +1,273 @@
+"""Splits a batch into units of work that worker processes, possibly on other hosts, lease from a shared spool folder.
+
+    python spool.py /shared/spool --workers 8        # on every node
+    python cli.py recipe.json photos -o /shared/out --spool /shared/spool
+
+Every job is a folder in the spool holding job.json (the recipe and options) and three folders of units:
+
+    units/   units waiting for a worker, e.g. 00012.json listing its files and their outputs
+    leased/  units being processed, moved here by the worker that leased them (renaming is atomic, so only one worker
+             gets each unit) as 00012@<worker>.json
+    done/    the results of finished units, written by the worker (failed units go in failed/)
+
+A worker keeps its lease alive by touching the leased file. The coordinator moves units whose lease hasn't been touched
+for lease_timeout seconds back to units/, so the units of a dead worker are processed by another. The spool and every
+input and output must be on paths all the hosts see the same way, and the clocks of the hosts should agree to well
+within lease_timeout."""
+
+from os import path
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import pipeline
+import recipe
+
+LEASE_TIMEOUT = 60
+POLL_INTERVAL = 0.5
+
+def write_json(filename, data):
+    """Writes data through a temporary file so readers never see half of it."""
+
+    temp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_filename, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_filename, filename)
+
+def read_json(filename):
+    with open(filename, encoding='utf-8') as f:
+        return json.load(f)
+
+def list_json(folder):
+    try:
+        return sorted(name for name in os.listdir(folder) if name.endswith('.json'))
+    except FileNotFoundError:
+        return []
+
+class Coordinator:
+
+    """Runs jobs through the workers serving a spool. on_submit is called with the job folder once its units are
+    ready, e.g. to start local workers for it."""
+
+    def __init__(self, spool, unit_size=16, lease_timeout=LEASE_TIMEOUT, on_submit=None):
+        self.spool = spool
+        self.unit_size = unit_size
+        self.lease_timeout = lease_timeout
+        self.on_submit = on_submit
+        self.stats = {} # Worker -> dict(units, files, seconds) of the last job
+
+    def submit(self, filenames, outfiles, modifiers, options):
+        job = path.join(self.spool, f'{time.strftime("%Y%m%d-%H%M%S")}-{socket.gethostname()}-{os.getpid()}')
+        for folder in ('units', 'leased', 'done', 'failed'):
+            os.makedirs(path.join(job, folder))
+
+        write_json(path.join(job, 'job.json'), dict(recipe=recipe.to_dict(modifiers), options=options))
+
+        files = [(path.abspath(filename), path.abspath(outfile)) for filename, outfile in zip(filenames, outfiles)]
+        for number, start in enumerate(range(0, len(files), self.unit_size)):
+            write_json(path.join(job, 'units', f'{number:05}.json'), dict(files=files[start:start + self.unit_size]))
+
+        return job
+
+    def run(self, filenames, outfiles, modifiers, options, on_result=None):
+        """Processes the files and returns a pipeline.FileResult for each (in the order units finish). options are
+        the keyword arguments of pipeline.process_files the workers use. on_result is called (on the calling thread)
+        with each FileResult as the units finish."""
+
+        if not filenames:
+            return []
+
+        job = self.submit(filenames, outfiles, modifiers, options)
+        unit_count = len(list_json(path.join(job, 'units')))
+        finished = set()
+        results = []
+        self.stats = {}
+
+        if self.on_submit:
+            self.on_submit(job)
+
+        try:
+            while len(finished) < unit_count:
+                for name in list_json(path.join(job, 'failed')):
+                    failure = read_json(path.join(job, 'failed', name))
+                    raise RuntimeError(f'worker {failure["worker"]} failed on unit {name[:-5]}:\n{failure["error"]}')
+
+                for name in list_json(path.join(job, 'done')):
+                    if name in finished:
+                        continue
+                    finished.add(name)
+                    done = read_json(path.join(job, 'done', name))
+
+                    stats = self.stats.setdefault(done['worker'], dict(units=0, files=0, seconds=0.0))
+                    stats['units'] += 1
+                    stats['files'] += len(done['results'])
+                    stats['seconds'] += done['finished'] - done['started']
+
+                    for filename, outfile, digest in done['results']:
+                        results.append(pipeline.FileResult(filename, outfile, digest))
+                        if on_result:
+                            on_result(results[-1])
+
+                self.expire_leases(job, finished)
+                if len(finished) < unit_count:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            # Tells the workers to stop looking at the job
+            open(path.join(job, 'finished'), 'w').close()
+
+        shutil.rmtree(job, ignore_errors=True)
+        return results
+
+    def expire_leases(self, job, finished):
+        now = time.time()
+
+        for name in list_json(path.join(job, 'leased')):
+            leased = path.join(job, 'leased', name)
+            unit = name.split('@')[0] + '.json'
+
+            try:
+                if unit in finished:
+                    os.remove(leased)
+                elif now - os.stat(leased).st_mtime > self.lease_timeout:
+                    os.rename(leased, path.join(job, 'units', unit))
+            except OSError:
+                # The worker finished or renewed it in the meantime
+                pass
+
+    def get_summary(self):
+        lines = [f'{"Worker":<40}{"Units":>7}{"Files":>8}{"Files/s":>10}']
+        for worker, stats in sorted(self.stats.items()):
+            rate = stats['files'] / stats['seconds'] if stats['seconds'] else 0
+            lines.append(f'{worker:<40}{stats["units"]:>7}{stats["files"]:>8}{rate:>10.1f}')
+        return '\n'.join(lines)
+
+class Worker:
+
+    """Leases units from the jobs in a spool and processes them with pipeline.process_files on workers processes."""
+
+    def __init__(self, spool, name=None, workers=1, lease_timeout=LEASE_TIMEOUT):
+        self.spool = spool
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self.workers = workers
+        self.lease_timeout = lease_timeout
+        self.jobs = {} # Job folder -> (modifiers, options)
+
+    def get_jobs(self):
+        try:
+            names = sorted(os.listdir(self.spool))
+        except FileNotFoundError:
+            return []
+        jobs = [path.join(self.spool, name) for name in names]
+        return [job for job in jobs if path.isfile(path.join(job, 'job.json')) and not path.exists(path.join(job, 'finished'))]
+
+    def lease(self, job):
+        """Returns the name and leased path of a unit of job, or None if it has no units waiting."""
+
+        for name in list_json(path.join(job, 'units')):
+            unit = path.join(job, 'units', name)
+            leased = path.join(job, 'leased', f'{name[:-5]}@{self.name}.json')
+            try:
+                # Renaming keeps the modification time, which the coordinator takes as the time of the last renewal,
+                # so the unit is touched first or one that waited longer than lease_timeout would expire at once
+                os.utime(unit)
+                os.rename(unit, leased)
+            except OSError:
+                # Another worker got it first
+                continue
+            return name, leased
+
+        return None
+
+    def renew(self, leased, stop):
+        while not stop.wait(self.lease_timeout / 4):
+            try:
+                os.utime(leased)
+            except OSError:
+                # The lease expired and the unit was handed to another worker. Finishing it anyway does no harm since
+                # outputs are replaced in one step.
+                return
+
+    def process(self, job, name, leased):
+        if job not in self.jobs:
+            data = read_json(path.join(job, 'job.json'))
+            self.jobs[job] = (recipe.from_dict(data['recipe']), data['options'])
+        modifiers, options = self.jobs[job]
+
+        try:
+            files = read_json(leased)['files']
+        except OSError:
+            # The lease expired already and the unit went back to units/
+            return
+        stop = threading.Event()
+        threading.Thread(target=self.renew, args=(leased, stop), daemon=True).start()
+        started = time.time()
+
+        try:
+            filenames = [filename for filename, _ in files]
+            outfiles = [outfile for _, outfile in files]
+            results = pipeline.process_files(filenames, modifiers, '', workers=self.workers, outfiles=outfiles, **options)
+        except Exception:
+            write_json(path.join(job, 'failed', name), dict(worker=self.name, error=traceback.format_exc()))
+            return
+        finally:
+            stop.set()
+
+        results = [(result.filename, result.outfile, result.digest) for result in results]
+        write_json(path.join(job, 'done', name), dict(worker=self.name, started=started, finished=time.time(), results=results))
+
+        try:
+            os.remove(leased)
+        except OSError:
+            pass
+
+    def run(self, job=None, cancelled=None):
+        """Processes units until cancelled (a threading.Event) is set. If job is given only its units are processed
+        and run returns once it's finished."""
+
+        while cancelled is None or not cancelled.is_set():
+            jobs = [job] if job else self.get_jobs()
+            if job and (not path.isdir(job) or path.exists(path.join(job, 'finished'))):
+                return
+
+            for current in jobs:
+                unit = self.lease(current)
+                if unit:
+                    self.process(current, *unit)
+                    break
+            else:
+                time.sleep(POLL_INTERVAL)
+
+def start_local_workers(job, count, workers=1):
+    """Starts count worker processes on this host for job, standing in for other nodes."""
+
+    script = path.abspath(__file__)
+    return [subprocess.Popen([sys.executable, script, path.dirname(job), '--job', job, '--workers', str(workers), '--name', f'local-{index}'])
+            for index in range(count)]
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Process units of the PillowGUI jobs in a spool folder.')
+    parser.add_argument('spool', help='spool folder shared with the coordinator')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--name', help='name of this worker in the coordinator\'s summary (default: host-pid)')
+    parser.add_argument('--job', help='only process this job folder and exit when it\'s finished')
+    parser.add_argument('--lease-timeout', type=float, default=LEASE_TIMEOUT, help='lease timeout the coordinator uses, leases are renewed every quarter of it (default: %(default)s)')
+    return parser
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    worker = Worker(args.spool, args.name and f'{socket.gethostname()}-{args.name}', max(1, args.workers), args.lease_timeout)
+
+    try:
+        worker.run(args.job)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""An on-disk cache of small thumbnails, so a folder that has been browsed before shows its thumbnails without decoding
+the originals again. Doesn't depend on tkinter.
+
+Thumbnails are JPEGs named after a hash of the source's absolute path, size, modification time and the thumbnail
+size, so a changed source simply misses. The least recently used thumbnails are deleted once the cache grows past
+max_bytes (see cache.DiskCache)."""
+
+from PIL import Image
+from os import path
+import hashlib
+import os
+from cache import DiskCache
+import cache
+
+THUMBNAIL_SIZE = (64, 64)
+
+def get_cache_dir():
+    return cache.get_cache_dir('thumbnails')
+
+def make_thumbnail(filename, size=THUMBNAIL_SIZE):
+    """Returns an RGB thumbnail fitting within size. JPEGs are decoded at a reduced size (see Image.thumbnail)."""
+
+    with Image.open(filename) as im:
+        if im.mode in ('I', 'F') or im.mode.startswith('I;'):
+            # Integer and float images can't be reduced or converted to RGB directly
+            im = im.convert('L')
+        im.thumbnail(size)
+        return im.convert('RGB')
+
+class ThumbnailCache(DiskCache):
+    def __init__(self, folder=None, max_bytes=256 << 20, size=THUMBNAIL_SIZE):
+        super().__init__(folder or get_cache_dir(), max_bytes, '.jpg')
+        self.size = size
+
+    def get_path(self, filename):
+        """Returns the path the thumbnail of filename is cached at, or None if filename can't be read."""
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        key = f'{path.abspath(filename)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{self.size[0]}x{self.size[1]}'
+        return path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + '.jpg')
+
+    def get(self, filename):
+        """Returns the thumbnail of filename, making and caching it if it isn't cached. Returns None for files that
+        can't be decoded."""
+
+        thumbnail_path = self.get_path(filename)
+        if thumbnail_path is None:
+            return None
+
+        try:
+            with Image.open(thumbnail_path) as im:
+                im.load()
+            self.touch(thumbnail_path)
+            return im
+        except OSError:
+            pass
+
+        try:
+            im = make_thumbnail(filename, self.size)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+
+        self.put(thumbnail_path, lambda temp_path: im.save(temp_path, 'JPEG', quality=85))
+        return im
@@ -0,0 +1,120 @@
+"""Applies a plan to a large image a tile at a time, so that the intermediate images are the size of a tile rather than
+the size of the image.
+
+Only plans of crops, point modifiers and sharpness can be tiled:
+    * Crops select which part of the source the tiles come from, the cropped away pixels are never processed.
+    * Point modifiers work pixel by pixel. Their contrast means depend on the whole image, so each PointModifier with
+      a contrast modifier first gets the histogram of its input, which takes an extra pass over the tiles.
+    * Sharpness uses a 3x3 kernel, so its tiles are read with a one pixel halo which is cut off afterwards. Pillow
+      leaves the outermost pixels of an image unfiltered and tiles on the edge of the image do the same.
+The output is identical to applying the plan to the whole image."""
+
+from PIL import Image
+from modifiers import PointModifier, SharpnessModifier
+from planner import ResampleStep
+
+TILE_SIZE = 1024
+
+# Images with fewer pixels than this are processed whole, tiling them would only add overhead
+MIN_PIXELS = 1 << 26
+
+# Pixels around a tile that each kind of step needs to compute the tile
+HALOS = {SharpnessModifier: 1}
+
+def is_crop(step):
+    if not isinstance(step, ResampleStep):
+        return False
+    left_x, left_y, right_x, right_y = step.box
+    return step.size == (right_x - left_x, right_y - left_y) and all(float(value).is_integer() for value in step.box)
+
+def can_tile(steps, image):
+    if image.mode not in PointModifier.MODES:
+        return False
+    return all(isinstance(step, (PointModifier, SharpnessModifier)) or is_crop(step) for step in steps)
+
+def get_sizes(steps, size):
+    """Returns the size of the input of every step followed by the size of the output."""
+
+    sizes = [size]
+    for step in steps:
+        sizes.append(step.output_size(sizes[-1]))
+    return sizes
+
+def get_regions(steps, sizes, box):
+    """Returns the region of the input of every step that is needed to compute box of the output, followed by box."""
+
+    regions = [box]
+
+    for step, size in zip(reversed(steps), reversed(sizes[:-1])):
+        left_x, left_y, right_x, right_y = regions[0]
+
+        if is_crop(step):
+            x, y = int(step.box[0]), int(step.box[1])
+            region = (left_x + x, left_y + y, right_x + x, right_y + y)
+        else:
+            halo = HALOS.get(type(step), 0)
+            region = (max(0, left_x - halo), max(0, left_y - halo), min(size[0], right_x + halo), min(size[1], right_y + halo))
+
+        regions.insert(0, region)
+
+    return regions
+
+def get_boxes(size, tile_size):
+    for top in range(0, size[1], tile_size):
+        for left in range(0, size[0], tile_size):
+            yield left, top, min(left + tile_size, size[0]), min(top + tile_size, size[1])
+
+def apply_tile(image, steps, sizes, box):
+    """Returns box of the output of steps applied to image."""
+
+    regions = get_regions(steps, sizes, box)
+    tile = image.crop(regions[0])
+
+    for step, region, next_region in zip(steps, regions, regions[1:]):
+        # A crop's tile is already the right part of its input
+        if is_crop(step):
+            continue
+
+        tile = step.apply(tile)
+
+        if next_region != region:
+            left_x, left_y = region[0], region[1]
+            tile = tile.crop((next_region[0] - left_x, next_region[1] - left_y, next_region[2] - left_x, next_region[3] - left_y))
+
+    return tile
+
+def add_histograms(total, histogram):
+    if total is None:
+        return histogram
+    return [a + b for a, b in zip(total, histogram)]
+
+def bind_histograms(image, steps, tile_size):
+    """Returns steps with every PointModifier that has a contrast modifier taking its means from the histogram of its
+    whole input."""
+
+    steps = list(steps)
+    sizes = get_sizes(steps, image.size)
+
+    for index, step in enumerate(steps):
+        if isinstance(step, PointModifier) and step.needs_histogram():
+            histogram = None
+            for box in get_boxes(sizes[index], tile_size):
+                histogram = add_histograms(histogram, apply_tile(image, steps[:index], sizes[:index + 1], box).histogram())
+            steps[index] = step.with_histogram(histogram)
+
+    return steps
+
+def apply_tiled(image, steps, tile_size=TILE_SIZE):
+    """Applies steps (which can_tile) to image tile by tile and returns the output."""
+
+    steps = bind_histograms(image, steps, tile_size)
+    sizes = get_sizes(steps, image.size)
+    output = None
+
+    for box in get_boxes(sizes[-1], tile_size):
+        tile = apply_tile(image, steps, sizes, box)
+        if output is None:
+            output = Image.new(tile.mode, sizes[-1])
+        output.paste(tile, box[:2])
+
+    return output
@@ -0,0 +1,300 @@
+"""Watches folders for new images and runs them through a batch's modifiers as they arrive. Doesn't depend on tkinter.
+
+    python cli.py recipe.json ingest/ -o processed --watch
+
+Only files directly in the watched folders are picked up, once they're fully written: on Linux when inotify reports
+that a file was closed after writing or moved into the folder, elsewhere when polling sees its size and modification
+time stay the same for settle seconds. Arrivals are collected into bursts that are processed together, a burst
+starting at most max_delay seconds after its first file arrived."""
+
+from collections import deque, namedtuple
+from os import path
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+from manifest import Manifest
+from scanner import SUPPORTED_FILE_EXTENSIONS
+
+POLL_INTERVAL = 1.0
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, length of the name that follows
+
+# Files waiting to be processed (queued), files processed and that failed, bursts processed and the seconds between a
+# file arriving and its output being written, over the most recent files
+WatchStats = namedtuple('WatchStats', ('queued', 'processed', 'failed', 'bursts', 'mean_latency', 'p95_latency', 'max_latency'))
+
+def is_image(filename, extensions=SUPPORTED_FILE_EXTENSIONS):
+    name = path.basename(filename)
+    # Skips hidden files, which is how many programs name files they're still writing
+    return not name.startswith('.') and path.splitext(name)[1][1:].lower() in extensions
+
+class InotifySource:
+
+    """Reports the files that are closed after writing or moved into folders, using inotify."""
+
+    def __init__(self, folders):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.folders = {}
+        for folder in folders:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f'could not watch {folder}')
+            self.folders[wd] = folder
+
+    def read(self, timeout):
+        """Returns the files that were written within timeout seconds, waiting for at least one."""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        filenames = []
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if wd in self.folders and name:
+                filenames.append(path.join(self.folders[wd], name))
+        return filenames
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingSource:
+
+    """Reports the files in folders that have been added or changed and then left alone for settle seconds."""
+
+    def __init__(self, folders, interval=POLL_INTERVAL, settle=POLL_INTERVAL):
+        self.folders = folders
+        self.interval = interval
+        self.settle = settle
+        self.seen = self.list_files() # Path -> (size, modification time) when it was last reported
+        self.changing = {} # Path -> ((size, modification time), when it was first seen like that)
+
+    def list_files(self):
+        files = {}
+        for folder in self.folders:
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_file():
+                                stat = entry.stat()
+                                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return files
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        now = time.monotonic()
+        filenames = []
+
+        files = self.list_files()
+        for filename, stat in files.items():
+            if self.seen.get(filename) == stat:
+                continue
+            previous, since = self.changing.get(filename, (None, now))
+            if previous != stat:
+                self.changing[filename] = (stat, now)
+            elif now - since >= self.settle:
+                del self.changing[filename]
+                self.seen[filename] = stat
+                filenames.append(filename)
+
+        # Forget deleted files, so a file copied in again under the same name is picked up
+        for filename in set(self.seen) - set(files):
+            del self.seen[filename]
+        for filename in set(self.changing) - set(files):
+            del self.changing[filename]
+
+        return filenames
+
+    def close(self):
+        pass
+
+def get_source(folders, poll_interval=POLL_INTERVAL):
+    """Returns an InotifySource where inotify is available and a PollingSource otherwise."""
+
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifySource(folders)
+        except (OSError, AttributeError): # e.g. out of watches, or a libc without inotify
+            pass
+    return PollingSource(folders, poll_interval, poll_interval)
+
+class Watcher:
+
+    """Processes the images that arrive in folders with batch.process_all, in bursts of at most max_batch files.
+    Processing starts at most max_delay seconds after the first file of a burst arrived, so a steady trickle of files is
+    processed with a bounded latency while a flood is processed in large batches. on_burst is called with the
+    FileResults of every burst. The save destination's manifest is loaded once, appended to as files are processed and
+    compacted when the watcher stops, so a burst doesn't cost more the more files have been processed."""
+
+    def __init__(self, batch, folders, max_delay=0.5, max_batch=64, workers=1, poll_interval=POLL_INTERVAL, on_burst=None):
+        self.batch = batch
+        self.folders = list(folders)
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.on_burst = on_burst
+
+        self.arrivals = queue.Queue() # (filename, when it arrived) from the source's thread
+        self.pending = {} # Filename -> when it arrived, of the files waiting for the next burst
+        self.latencies = deque(maxlen=1000)
+        self.processed = 0
+        self.failed = 0
+        self.bursts = 0
+        self.lock = threading.Lock()
+        self.manifest = None
+
+    def get_outfile(self, filename):
+        """Returns the output path of a file in one of the folders. With several folders, outputs keep the path of
+        their folder below the folder all the watched folders are in, so same-named files in different folders don't
+        overwrite each other."""
+
+        if len(self.folders) == 1:
+            return path.join(self.batch.save_dest, path.basename(filename))
+
+        folders = [path.abspath(folder) for folder in self.folders]
+        folder = path.dirname(path.abspath(filename))
+        try:
+            subfolder = path.relpath(folder, path.commonpath(folders))
+        except ValueError: # On different drives
+            subfolder = path.splitdrive(folder)[1].lstrip('\\/')
+        return path.normpath(path.join(self.batch.save_dest, subfolder, path.basename(filename)))
+
+    def read_source(self, source, cancelled):
+        # Reads on its own thread so arrivals are timed while a burst is being processed
+        try:
+            while not cancelled.is_set():
+                for filename in source.read(self.poll_interval):
+                    if is_image(filename):
+                        self.arrivals.put((filename, time.monotonic()))
+        finally:
+            source.close()
+
+    def run(self, cancelled=None):
+        """Processes arrivals until cancelled (a threading.Event) is set."""
+
+        cancelled = cancelled or threading.Event()
+        self.manifest = Manifest(self.batch.save_dest, self.batch.get_recipe_digest())
+        source = get_source(self.folders, self.poll_interval)
+        threading.Thread(target=self.read_source, args=(source, cancelled), name='watch', daemon=True).start()
+
+        # Files that arrived while nothing was watching are caught up on, the save destination's manifest skips
+        # those that were already processed (if the batch is incremental)
+        now = time.monotonic()
+        for folder in self.folders:
+            for filename in sorted(os.listdir(folder)):
+                filename = path.join(folder, filename)
+                if is_image(filename) and path.isfile(filename):
+                    self.arrivals.put((filename, now))
+
+        try:
+            while not cancelled.is_set():
+                timeout = self.poll_interval
+                if self.pending:
+                    timeout = max(0, self.get_deadline() - time.monotonic())
+
+                try:
+                    filename, arrived = self.arrivals.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+                else:
+                    with self.lock:
+                        # A file written again before it was processed keeps its first arrival
+                        self.pending.setdefault(filename, arrived)
+
+                if self.pending and (len(self.pending) >= self.max_batch or time.monotonic() >= self.get_deadline()):
+                    self.process_burst()
+        finally:
+            self.manifest.compact()
+
+    def get_deadline(self):
+        # Files are pending in the order they arrived
+        return next(iter(self.pending.values())) + self.max_delay
+
+    def take_burst(self):
+        with self.lock:
+            burst = dict(list(self.pending.items())[:self.max_batch])
+            for filename in burst:
+                del self.pending[filename]
+        return burst
+
+    def process_burst(self):
+        burst = self.take_burst()
+        results = []
+
+        def record(result):
+            results.append(result)
+            arrived = burst.get(result.filename)
+            if arrived is not None:
+                with self.lock:
+                    self.latencies.append(time.monotonic() - arrived)
+
+        # Starting a pool of worker processes only pays off for large bursts
+        workers = self.workers if len(burst) >= self.workers * 4 else 1
+
+        try:
+            self.batch.process_all(workers, filenames=list(burst), outfiles=[self.get_outfile(filename) for filename in burst], on_result=record,
+                                   manifest=self.manifest)
+        except Exception:
+            # One bad file stops the whole burst, so the rest are retried one at a time to find it
+            done = {result.filename for result in results}
+            for filename in burst:
+                if filename in done:
+                    continue
+                try:
+                    self.batch.process_all(1, filenames=[filename], outfiles=[self.get_outfile(filename)], on_result=record,
+                                           manifest=self.manifest)
+                except Exception:
+                    self.failed += 1
+                    print(f'error: could not process {filename}:\n{traceback.format_exc()}', file=sys.stderr)
+
+        self.processed += len(results)
+        self.bursts += 1
+        if self.on_burst:
+            self.on_burst(results)
+
+    def get_stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            queued = len(self.pending) + self.arrivals.qsize()
+        if not latencies:
+            return WatchStats(queued, self.processed, self.failed, self.bursts, 0.0, 0.0, 0.0)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return WatchStats(queued, self.processed, self.failed, self.bursts, sum(latencies) / len(latencies), p95, latencies[-1])
+
+    def get_status(self):
+        stats = self.get_stats()
+        return (f'{stats.processed} processed | {stats.failed} failed | {stats.queued} queued | {stats.bursts} bursts | '
+                f'latency mean {stats.mean_latency * 1000:.0f}ms p95 {stats.p95_latency * 1000:.0f}ms max {stats.max_latency * 1000:.0f}ms')
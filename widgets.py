@@ -1,16 +1,40 @@
 from PIL import Image, ImageEnhance, ImageTk
 from tkinter import Tk, Menu, Button, Label, Listbox, Canvas, Scrollbar, Toplevel, Scale, END, Checkbutton, Radiobutton, StringVar, IntVar, Entry, Spinbox, OptionMenu
 from tkinter.filedialog import askopenfilenames, askdirectory
+from tkinter.ttk import Progressbar
+from thumbnails import THUMBNAIL_SIZE
+from cache import LRUCache
 import modifiers
 from os import path
 from glob import glob
+import bisect
 
 class FilePane:
-    def __init__(self, root, items=list(), on_selection=list(), on_close=list()):
+
+    """Lists files with a thumbnail next to each, drawing only the rows that are visible so that lists of hundreds of
+    thousands of files open instantly. The list shows items, a sequence the pane keeps a reference to rather than
+    copying (call update after appending to it), optionally filtered by a search over the file names.
+
+    Thumbnails come from thumbnails (a background.WorkQueue over ThumbnailCache.get) and are only requested for the
+    rows that are visible."""
+
+    def __init__(self, root, items=list(), on_selection=list(), on_close=list(), thumbnails=None, thumbnail_size=THUMBNAIL_SIZE):
         self.items = items
-        self.item_count = len(items)
         self.on_selection = on_selection
         self.on_close = on_close
+        self.thumbnails = thumbnails
+        self.thumbnail_size = thumbnail_size if thumbnails else (0, 0)
+        self.row_height = self.thumbnail_size[1] + 4 if thumbnails else 20
+        self.photos = LRUCache(max_entries=512) # Filename -> PhotoImage of its thumbnail
+        self.redraw_pending = False
+
+        self.view = None # Indexes of the items matching the filter in order, None when there's no filter
+        self.filtered_count = 0 # Number of items the filter has looked at
+        self.selected = None # Index of the selected item
+        self.position = None # Row of the selected item, None if it's filtered out
+        self.direction = 1 # Direction the list was last stepped through in, 1 or -1
+        self.offset = 0 # Pixels the list is scrolled down by
+        self.filter_job = None
 
         self.window = Toplevel()
         self.window.title('Files')
@@ -24,14 +48,25 @@ class FilePane:
         # Display the menu
         self.window.config(menu=self.menubar)
 
-        self.scrollbar = Scrollbar(self.window, orient='vertical')
-        self.listbox = Listbox(self.window, yscrollcommand=self.scrollbar.set, exportselection=False)
-        self.set_items(items)
-        self.scrollbar.config(command=self.listbox.yview)
+        self.filter_text = StringVar()
+        self.filter_entry = Entry(self.window, textvariable=self.filter_text)
+        self.filter_entry.pack(side='top', fill='x')
+        self.filter_text.trace('w', self.on_filter_change)
+
+        self.scrollbar = Scrollbar(self.window, orient='vertical', command=self.on_scrollbar)
+        self.canvas = Canvas(self.window, background='white', highlightthickness=0, takefocus=1)
         self.scrollbar.pack(side='right', fill='y')
-        self.listbox.pack(side='left', fill='both', expand=1)
+        self.canvas.pack(side='left', fill='both', expand=1)
+
+        self.canvas.bind('<Configure>', lambda event: self.draw())
+        self.canvas.bind('<Button-1>', self.on_click)
+        self.canvas.bind('<MouseWheel>', lambda event: self.scroll(-event.delta // 120 * 3 * self.row_height))
+        self.canvas.bind('<Button-4>', lambda event: self.scroll(-3 * self.row_height))
+        self.canvas.bind('<Button-5>', lambda event: self.scroll(3 * self.row_height))
+        self.canvas.bind('<Up>', lambda event: self.previous())
+        self.canvas.bind('<Down>', lambda event: self.next())
 
-        self.listbox.bind('<<ListboxSelect>>', self.on_select)
+        self.set_items(items)
 
     def on_window_close(self):
         for callback in self.on_close:
@@ -44,43 +79,196 @@ class FilePane:
     def show(self):
         self.window.deiconify()
 
+    @property
+    def item_count(self):
+        return len(self.items)
+
+    def row_count(self):
+        return len(self.items) if self.view is None else len(self.view)
+
+    def index_at(self, position):
+        return position if self.view is None else self.view[position]
+
+    def selected_index(self):
+        return self.selected
+
     def selected_item(self):
-        return self.items[self.listbox.curselection()[0]]
+        return self.items[self.selected]
 
     def select_index(self, index):
-        self.listbox.selection_clear(0, END)
+        self.selected = index
+        self.position = self.get_position(index)
+        if self.position is not None:
+            self.see(self.position)
+        self.draw()
+
+        for callback in self.on_selection:
+            callback(self.selected_item())
+
+    def select_position(self, position):
+        self.select_index(self.index_at(position))
+
+    def get_position(self, index):
+        """Returns the row of the item at index, or None if it's filtered out."""
+
+        if self.view is None:
+            return index if index is not None and index < len(self.items) else None
 
-        # From https://stackoverflow.com/a/25451279/11628429
-        self.listbox.select_set(index) #This only sets focus on the first item. 
-        self.listbox.event_generate("<<ListboxSelect>>")
+        position = bisect.bisect_left(self.view, index)
+        return position if position < len(self.view) and self.view[position] == index else None
+
+    def get_following(self, count):
+        """Returns up to count items after the selected one in the direction the list was last stepped through."""
+
+        rows = self.row_count()
+        if self.position is None:
+            return []
+        steps = range(1, min(count, rows - 1) + 1)
+        return [self.items[self.index_at((self.position + self.direction * step) % rows)] for step in steps]
 
     def set_items(self, items):
         self.items = items
-        self.item_count = len(items)
-        self.listbox.delete(0, END)
+        self.selected = self.position = None
+        self.offset = 0
+        self.photos.clear()
+        if self.thumbnails:
+            self.thumbnails.clear()
 
-        for item in items:
-            item = path.split(item)[1]
-            self.listbox.insert(END, item)
-        
-        self.select_index(0)
+        self.apply_filter()
+
+        if self.items:
+            self.select_index(0)
+
+    def update(self):
+        """Shows the items appended to items since the last call."""
+
+        self.apply_filter(keep_view=True)
+        self.draw()
+
+    def on_filter_change(self, *args):
+        # Filtering looks at every name, so it waits for a pause in typing
+        if self.filter_job is not None:
+            self.window.after_cancel(self.filter_job)
+        self.filter_job = self.window.after(150, self.refilter)
+
+    def refilter(self):
+        self.filter_job = None
+        self.offset = 0
+        self.apply_filter()
+        if self.position is not None:
+            self.see(self.position)
+        self.draw()
+
+    def apply_filter(self, keep_view=False):
+        """Works out which items match the filter. With keep_view only the items after those already filtered are
+        looked at."""
+
+        text = self.filter_text.get().lower()
+
+        if not text:
+            self.view = None
+        else:
+            keep_view = keep_view and self.view is not None
+            start = self.filtered_count if keep_view else 0
+            view = self.view if keep_view else []
+            view += [index for index in range(start, len(self.items)) if text in path.basename(self.items[index]).lower()]
+            self.view = view
+
+        self.filtered_count = len(self.items)
+        self.position = self.get_position(self.selected)
+
+    def on_click(self, event):
+        self.canvas.focus_set()
+        position = (event.y + self.offset) // self.row_height
+        if 0 <= position < self.row_count():
+            if self.position is not None and position != self.position:
+                self.direction = 1 if position > self.position else -1
+            self.select_position(position)
 
     def previous(self):
-        index = self.listbox.curselection()[0] - 1
-        if index < 0:
-            index = self.item_count - 1
-        self.select_index(index)
+        rows = self.row_count()
+        if rows:
+            self.direction = -1
+            self.select_position((self.position - 1) % rows if self.position is not None else rows - 1)
 
     def next(self):
-        index = self.listbox.curselection()[0] + 1
-        if index >= self.item_count:
-            index = 0
-        self.select_index(index)
+        rows = self.row_count()
+        if rows:
+            self.direction = 1
+            self.select_position((self.position + 1) % rows if self.position is not None else 0)
+
+    def on_scrollbar(self, action, amount, units=None):
+        if action == 'moveto':
+            self.offset = float(amount) * self.row_count() * self.row_height
+        elif units == 'pages':
+            self.offset += int(amount) * self.canvas.winfo_height()
+        else:
+            self.offset += int(amount) * self.row_height
+        self.draw()
+
+    def scroll(self, pixels):
+        self.offset += pixels
+        self.draw()
+
+    def see(self, position):
+        top = position * self.row_height
+        height = self.canvas.winfo_height()
+        if top < self.offset:
+            self.offset = top
+        elif top + self.row_height > self.offset + height:
+            self.offset = top + self.row_height - height
+
+    def draw(self):
+        """Draws the visible rows. There are only ever a screenful of them, so they're redrawn from scratch."""
+
+        self.redraw_pending = False
+        rows = self.row_count()
+        height = max(1, self.canvas.winfo_height())
+        width = self.canvas.winfo_width()
+        total = rows * self.row_height
+
+        self.offset = int(max(0, min(self.offset, total - height)))
+        if total:
+            self.scrollbar.set(self.offset / total, (self.offset + height) / total)
+        else:
+            self.scrollbar.set(0, 1)
+        self.canvas.delete('all')
 
-    def on_select(self, event):
-        if self.on_selection:
-            for callback in self.on_selection:
-                callback(self.selected_item())
+        first = self.offset // self.row_height
+        last = min(rows, (self.offset + height) // self.row_height + 1)
+        missing = []
+
+        for position in range(first, last):
+            item = self.items[self.index_at(position)]
+            y = position * self.row_height - self.offset
+            selected = position == self.position
+
+            if selected:
+                self.canvas.create_rectangle(0, y, width, y + self.row_height, fill='#3399ff', outline='')
+
+            photo = self.photos.get(item)
+            if photo is not None:
+                self.canvas.create_image(2 + self.thumbnail_size[0] // 2, y + self.row_height // 2, image=photo)
+            elif self.thumbnails:
+                missing.append(item)
+
+            self.canvas.create_text(self.thumbnail_size[0] + 6, y + self.row_height // 2, text=path.basename(item), anchor='w', fill='white' if selected else 'black')
+
+        if self.thumbnails:
+            self.thumbnails.replace(missing)
+
+    def set_thumbnail(self, filename, image):
+        """Shows the thumbnail of filename, called on the Tk thread with the results of thumbnails."""
+
+        if image is None:
+            return
+
+        self.photos.put(filename, ImageTk.PhotoImage(image))
+
+        # A burst of thumbnails only redraws once
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.window.after_idle(self.draw)
 
 class CustomDialog:
     def __init__(self, on_change=list(), on_cancel=list(), on_confirm=list()):
@@ -103,6 +291,41 @@ class CustomDialog:
             callback()
         self.window.destroy()
 
+class ProgressDialog:
+
+    """Shows how far a run has got, with a button (and the window's close button) that calls on_cancel."""
+
+    def __init__(self, root, title="Processing", on_cancel=list()):
+        self.on_cancel = on_cancel
+
+        self.window = Toplevel()
+        self.window.title(title)
+        self.window.transient(root)
+        self.window.resizable(False, False)
+        self.window.protocol('WM_DELETE_WINDOW', self.cancel)
+
+        self.bar = Progressbar(self.window, orient='horizontal', length=360, mode='determinate')
+        self.bar.grid(row=0, column=0, padx=10, pady=(10, 4), sticky='ew')
+
+        self.label = Label(self.window, text='Starting...', anchor='w')
+        self.label.grid(row=1, column=0, padx=10, sticky='ew')
+
+        self.cancel_button = Button(self.window, text='Cancel', command=self.cancel)
+        self.cancel_button.grid(row=2, column=0, pady=10)
+
+    def update(self, done, total, status):
+        self.bar.config(maximum=max(total, 1), value=done)
+        self.label.config(text=status)
+
+    def cancel(self):
+        # The run stops after the files under way, which may take a moment
+        self.cancel_button.config(text='Cancelling...', state='disabled')
+        for callback in self.on_cancel:
+            callback()
+
+    def close(self):
+        self.window.destroy()
+
 class SliderDialog(CustomDialog):
     def __init__(self, root, title="Slider Dialog", init_val=0, min_val=-1, max_val=1, default_val=0, on_change=list(), resolution=1, on_confirm=list(), on_cancel=list()):
         self.init_val = init_val